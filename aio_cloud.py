@@ -0,0 +1,194 @@
+import asyncio
+import functools
+import json
+import logging
+import threading
+
+import aiohttp
+from micloud.micloudexception import MiCloudException
+
+from ratelimit import LIMITER
+from xiaomi_cloud import MiotCloud, API_HEADERS
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class AsyncMiotCloud:
+    """Asyncio transport for MiotCloud.
+
+    Login, token cache, signing and rc4 stay in the wrapped MiotCloud,
+    only the blocking http requests are replaced by one aiohttp connection
+    pool, so hundreds of requests can be in flight on a single thread.
+    """
+
+    def __init__(self, cloud: MiotCloud, limit=100):
+        self.cloud = cloud
+        self.limit = limit
+        self._session = None
+
+    async def __aenter__(self):
+        await self.session()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.limit),
+                headers={
+                    'X-XIAOMI-PROTOCAL-FLAG-CLI': 'PROTOCAL-HTTP2',
+                    'User-Agent': self.cloud.useragent,
+                },
+                # Auth cookies are passed per api request and never reach the video cdn
+                cookie_jar=aiohttp.DummyCookieJar(),
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def api_cookies(self):
+        if not self.cloud.service_token or not self.cloud.user_id:
+            raise MiCloudException('Cannot execute request. service token or userId missing. Make sure to login.')
+        return self.cloud.api_cookies()
+
+    async def login(self):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.cloud.login)
+
+    async def request_miot_api(self, api, data, method='POST', debug=True, **kwargs):
+        token = self.cloud.service_token
+        rdt = await self._request_miot_api(api, data, method, debug, **kwargs)
+        # The token was rejected: login again (blocking, in executor) and retry once
+        if token and not self.cloud.service_token:
+            loop = asyncio.get_running_loop()
+            if await loop.run_in_executor(None, self.cloud.relogin, token):
+                rdt = await self._request_miot_api(api, data, method, debug, **kwargs)
+        return rdt
+
+    async def _request_miot_api(self, api, data, method='POST', debug=True, **kwargs):
+        params = {}
+        if data is not None:
+            params['data'] = self.cloud.json_encode(data)
+        attrs = self.cloud.attrs
+        rsp = None
+        try:
+            rsp = await self.request_rc4_api(api, params, method, **kwargs)
+            rdt = json.loads(rsp)
+            if debug:
+                _LOGGER.debug('Request miot api: %s %s result: %s', api, data, rsp)
+            attrs['timeouts'] = 0
+        except asyncio.TimeoutError as exc:
+            rdt = None
+            attrs.setdefault('timeouts', 0)
+            attrs['timeouts'] += 1
+            if 5 < attrs['timeouts'] <= 10:
+                _LOGGER.error('Request xiaomi api: %s %s timeout, exception: %s', api, data, exc)
+        except (TypeError, ValueError):
+            rdt = None
+        code = rdt.get('code') if rdt else None
+        if code == 3:
+            self.cloud._logout()
+            _LOGGER.warning('Unauthorized while executing request to %s, logged out.', api)
+        elif code or not rdt:
+            fun = _LOGGER.info if rdt else _LOGGER.warning
+            fun('Request xiaomi api: %s %s failed, response: %s', api, data, rsp)
+        return rdt
+
+    async def request_rc4_api(self, api, params: dict, method='POST', **kwargs):
+        cookies = self.api_cookies()
+        url = self.cloud.get_api_url(api)
+        timeout = aiohttp.ClientTimeout(total=kwargs.get('timeout', self.cloud.http_timeout))
+        headers = {
+            **API_HEADERS,
+            'MIOT-ENCRYPT-ALGORITHM': 'ENCRYPT-RC4',
+            'Accept-Encoding': 'identity',
+        }
+        params = self.cloud.rc4_params(method, url, params)
+        signed_nonce = self.cloud.signed_nonce(params['_nonce'])
+        session = await self.session()
+        req = dict(headers=headers, cookies=cookies, timeout=timeout)
+        if method == 'GET':
+            req['params'] = params
+        else:
+            req['data'] = params
+        await LIMITER.wait_api_async()
+        try:
+            async with session.request(method, url, **req) as response:
+                rsp = await response.text()
+                status = response.status
+        except aiohttp.ClientError as exc:
+            _LOGGER.warning('Error while executing request to %s: %s', url, exc)
+            return None
+        if status == 401:
+            self.cloud._logout()
+            _LOGGER.warning('Unauthorized while executing request to %s, logged out.', url)
+        if not rsp or 'error' in rsp or 'invalid' in rsp:
+            _LOGGER.warning('Error while executing request to %s: %s', url, rsp or status)
+        elif 'message' not in rsp:
+            try:
+                rsp = MiotCloud.decrypt_data(signed_nonce, rsp)
+            except ValueError:
+                _LOGGER.warning('Error while decrypting response of request to %s :%s', url, rsp)
+        return rsp
+
+    async def get_device_list(self):
+        rdt = await self.request_miot_api('home/device_list', {
+            'getVirtualModel': True,
+            'getHuamiDevices': 1,
+            'get_split_device': False,
+            'support_smart_home': True,
+        }, debug=False, timeout=60) or {}
+        if rdt and 'result' in rdt:
+            return rdt['result']['list']
+        _LOGGER.warning('Got xiaomi cloud devices for %s failed: %s', self.cloud.username, rdt)
+        return None
+
+    async def get_bytes(self, url, **kwargs):
+        session = await self.session()
+        async with session.get(url, **kwargs) as response:
+            response.raise_for_status()
+            return await response.read()
+
+
+class SyncFacade:
+    """Blocking facade over an async object, its coroutines run on a private event loop thread.
+
+        cloud = SyncFacade(AsyncMiotCloud(miot_cloud))
+        devices = cloud.get_device_list()
+    """
+
+    def __init__(self, target, loop=None):
+        self._target = target
+        self._own_loop = loop is None
+        self.loop = loop or asyncio.new_event_loop()
+        self._thread = None
+        if self._own_loop:
+            self._thread = threading.Thread(target=self.loop.run_forever, name='aio-facade', daemon=True)
+            self._thread.start()
+
+    def run(self, coro, timeout=None):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(timeout)
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if not asyncio.iscoroutinefunction(attr):
+            return attr
+
+        @functools.wraps(attr)
+        def call(*args, **kwargs):
+            return self.run(attr(*args, **kwargs))
+        return call
+
+    def close(self):
+        close = getattr(self._target, 'close', None)
+        if close and asyncio.iscoroutinefunction(close):
+            self.run(close())
+        if self._own_loop:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self._thread.join()
+            self.loop.close()
@@ -0,0 +1,91 @@
+import asyncio
+import functools
+import logging
+import os
+from typing import List
+
+from aio_cloud import AsyncMiotCloud
+from ratelimit import LIMITER
+from doorbell import (
+    MiDoorbell, DoorbellEvent, VideoSegment, SegmentDecryptor, parse_m3u8,
+    DEFAULT_DOWNLOAD_WORKERS, DEFAULT_MERGE_PROFILE, SEGMENT_CHUNK_SIZE,
+)
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class AsyncMiDoorbell:
+    """MiDoorbell的异步版本，请求参数、签名、播放列表解析和合并逻辑复用同步实现
+
+    仅支持segments分片处理方式，合并在线程池中执行，不阻塞事件循环。
+    """
+
+    def __init__(self, aio_cloud: AsyncMiotCloud, name, did, model):
+        self.aio_cloud = aio_cloud
+        self.name = name
+        self.miot_did = did
+        self.model = model
+        self.sync = MiDoorbell(aio_cloud.cloud, name, did, model)
+
+    async def get_event_list(self, start_time=None, end_time=None, limit=10) -> List[DoorbellEvent]:
+        api, rqd = self.sync.event_list_request(start_time, end_time, limit)
+
+        all_list = []
+        is_continue = True
+        next_time = rqd['endTime']
+
+        while is_continue:
+            rqd['endTime'] = next_time
+
+            rdt = await self.aio_cloud.request_miot_api(api, rqd, method='GET') or {}
+            events, is_continue, next_time = MiDoorbell.parse_event_page(rdt)
+            all_list.extend(events)
+
+        return all_list
+
+    def get_video_m3u8_url(self, event: DoorbellEvent):
+        return self.sync.get_video_m3u8_url(event)
+
+    async def get_segments(self, event: DoorbellEvent) -> List[VideoSegment]:
+        """获取并解析播放列表，不同的密钥并发下载"""
+        await LIMITER.wait_api_async()
+        playlist = await self.aio_cloud.get_bytes(self.get_video_m3u8_url(event))
+        items = parse_m3u8(playlist.splitlines())
+        uris = list(dict.fromkeys(key_uri for _, key_uri, _ in items))
+        keys = dict(zip(uris, await asyncio.gather(*(self.aio_cloud.get_bytes(u) for u in uris))))
+        return [
+            VideoSegment(index=i, url=url, key=keys[key_uri], iv=iv)
+            for i, (url, key_uri, iv) in enumerate(items, 1)
+        ]
+
+    async def download_segment(self, seg: VideoSegment, path, chunk_size=SEGMENT_CHUNK_SIZE):
+        session = await self.aio_cloud.session()
+        decryptor = SegmentDecryptor(seg.key, seg.iv, chunk_size)
+        async with session.get(seg.url) as r:
+            r.raise_for_status()
+            with open(path, 'wb') as f:
+                async for chunk in r.content.iter_chunked(chunk_size):
+                    await LIMITER.wait_bytes_async(len(chunk))
+                    for plain in decryptor.feed(chunk):
+                        f.write(plain)
+        return decryptor.finish(seg.url)
+
+    async def download_video(self, event: DoorbellEvent, save_path, merge=False, ffmpeg=None,
+                             workers=DEFAULT_DOWNLOAD_WORKERS, merge_profile=DEFAULT_MERGE_PROFILE):
+        segments = await self.get_segments(event)
+        video_dir, video_path, ts_path = self.sync.video_paths(event, save_path)
+        os.makedirs(ts_path, exist_ok=True)
+
+        # 每个视频最多同时下载workers个分片
+        sem = asyncio.Semaphore(max(1, workers))
+
+        async def fetch(seg):
+            async with sem:
+                await self.download_segment(seg, os.path.join(ts_path, f'{seg.index}.ts'))
+
+        await asyncio.gather(*(fetch(seg) for seg in segments))
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, functools.partial(
+            self.sync.merge_segment_files, len(segments), ts_path, video_path, merge, ffmpeg, merge_profile,
+        ))
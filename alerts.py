@@ -0,0 +1,107 @@
+import collections
+import logging
+import queue
+import sys
+import threading
+import time
+
+import requests
+
+# 企业微信文本消息内容的最大字节数
+WECHAT_MAX_BYTES = 2048
+
+_STOP = object()
+
+
+class WeChatWebhookHandler(logging.Handler):
+    """企业微信机器人通知，日志调用只把消息放入队列，不会阻塞下载和合并
+
+    后台线程把window秒内的错误合并为一条消息，相同内容只发送一次并注明次数；
+    两次发送至少间隔min_interval秒，期间的错误继续累积。队列满时直接丢弃并在下一条消息中说明丢弃数量。
+    """
+
+    def __init__(self, webhook_url, window=30, min_interval=60, max_queue=1000, max_items=20, timeout=5):
+        super().__init__(logging.ERROR)
+        self.webhook_url = webhook_url
+        self.window = window
+        self.min_interval = min_interval
+        self.max_items = max_items
+        self.timeout = timeout
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._session = requests.Session()
+        self._thread = threading.Thread(target=self._run, name='wechat-alert', daemon=True)
+        self._thread.start()
+
+    def emit(self, record):
+        try:
+            msg = self.format(record)
+        except Exception:
+            self.handleError(record)
+            return
+        try:
+            self._queue.put_nowait(msg)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        """进程退出时（logging.shutdown）发送尚未发出的消息"""
+        if self._thread.is_alive():
+            try:
+                self._queue.put(_STOP, timeout=1)
+            except queue.Full:
+                pass
+            self._thread.join(self.timeout + 1)
+        super().close()
+
+    def _run(self):
+        pending = collections.OrderedDict()
+        flush_at = 0
+        last_sent = float('-inf')
+        while True:
+            timeout = max(0, flush_at - time.monotonic()) if pending else None
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            if item is _STOP:
+                break
+            if item is not None:
+                if not pending:
+                    # 收到第一条错误后等待window秒，同时满足最小发送间隔
+                    flush_at = max(time.monotonic() + self.window, last_sent + self.min_interval)
+                pending[item] = pending.get(item, 0) + 1
+            if pending and time.monotonic() >= flush_at:
+                self._send(pending)
+                pending.clear()
+                last_sent = time.monotonic()
+        if pending or self.dropped:
+            self._send(pending)
+
+    def format_batch(self, pending):
+        lines = [f'[ERROR]门铃存档机器人 共{sum(pending.values())}条错误']
+        for msg, count in list(pending.items())[:self.max_items]:
+            lines.append(f'{msg} (×{count})' if count > 1 else msg)
+        if len(pending) > self.max_items:
+            lines.append(f'……另有{len(pending) - self.max_items}种错误')
+        dropped, self.dropped = self.dropped, 0
+        if dropped:
+            lines.append(f'通知队列已满，丢弃了{dropped}条错误')
+        content = '\n'.join(lines).encode('utf-8')
+        if len(content) > WECHAT_MAX_BYTES:
+            content = content[:WECHAT_MAX_BYTES - 3] + '...'.encode()
+        return content.decode('utf-8', errors='ignore')
+
+    def _send(self, pending):
+        data = {
+            'msgtype': 'text',
+            'text': {
+                'content': self.format_batch(pending),
+            },
+        }
+        try:
+            response = self._session.post(self.webhook_url, json=data, timeout=self.timeout)
+            response.raise_for_status()
+        except Exception as e:
+            # 发送失败不影响原有日志记录
+            sys.stderr.write(f'Failed to send WeChat notification: {e}\n')
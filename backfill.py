@@ -0,0 +1,177 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, List, NamedTuple, Optional
+
+import metrics
+from doorbell import MiDoorbell, DoorbellEvent
+from history import EventHistory
+
+_LOGGER = logging.getLogger(__name__)
+
+# 分页大小的上下限：整页返回时加倍，请求失败时减半
+MIN_PAGE_SIZE = 10
+MAX_PAGE_SIZE = 200
+# 单页请求失败后的重试次数及首次重试等待（秒），之后按倍数增加
+PAGE_RETRIES = 4
+PAGE_RETRY_DELAY = 2
+# 两次进度日志之间的最短间隔（秒）
+PROGRESS_INTERVAL = 10
+
+
+class Shard(NamedTuple):
+    cam: MiDoorbell
+    start: int
+    end: int
+
+
+class PageSize:
+    """所有分片共用的自适应分页大小"""
+
+    def __init__(self, size=50):
+        self.size = max(MIN_PAGE_SIZE, min(MAX_PAGE_SIZE, size))
+        self._lock = threading.Lock()
+
+    def grow(self):
+        with self._lock:
+            self.size = min(MAX_PAGE_SIZE, self.size * 2)
+
+    def shrink(self):
+        with self._lock:
+            self.size = max(MIN_PAGE_SIZE, self.size // 2)
+
+
+def format_seconds(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f'{seconds // 3600}h{seconds % 3600 // 60:02d}m'
+    if seconds >= 60:
+        return f'{seconds // 60}m{seconds % 60:02d}s'
+    return f'{seconds}s'
+
+
+class Backfill:
+    """停机后补齐云端保留期内的事件
+
+    把时间窗口按shard_hours切分，多个分片并行分页获取（每个分片内按nextTime顺序翻页），
+    相邻分片重叠overlap_seconds，按fileId去重后与已处理记录比对，新事件直接写入下载队列。
+    每完成一个分片调用on_enqueue，下载线程可以边补齐边下载。
+    """
+
+    def __init__(self, history: EventHistory, workers=4, shard_hours=6, page_size=50, overlap_seconds=60,
+                 on_enqueue: Optional[Callable[[], None]] = None):
+        self.history = history
+        self.workers = max(1, workers)
+        self.shard_ms = max(1, int(shard_hours * 3600 * 1000))
+        self.overlap_ms = int(overlap_seconds * 1000)
+        self.page_size = PageSize(page_size)
+        self.on_enqueue = on_enqueue
+        self._seen = set()
+        self._lock = threading.Lock()
+        self._done = 0
+        self._total = 0
+        self._found = 0
+        self._queued = 0
+        self._pages = 0
+        self._started = 0
+        self._last_report = 0
+
+    def shards(self, cams: List[MiDoorbell], begin, end) -> List[Shard]:
+        """从最早的时间开始切分，各门铃的分片交错排列，越早的事件越快被云端删除，优先获取"""
+        windows = []
+        start = begin
+        while start < end:
+            stop = min(end, start + self.shard_ms)
+            windows.append((max(begin, start - self.overlap_ms), stop))
+            start = stop
+        return [Shard(cam, start, stop) for start, stop in windows for cam in cams]
+
+    def run(self, cams: List[MiDoorbell], begin, end) -> int:
+        """补齐[begin, end]（毫秒）内的事件，返回写入下载队列的事件数"""
+        shards = self.shards(cams, begin, end)
+        if not shards:
+            return 0
+        self._total = len(shards)
+        self._started = self._last_report = time.monotonic()
+        _LOGGER.info('开始补齐 %d 个门铃的事件: %s ~ %s, 共%d个分片, 并发%d',
+                     len(cams), time.strftime('%Y-%m-%d %H:%M', time.localtime(begin / 1000)),
+                     time.strftime('%Y-%m-%d %H:%M', time.localtime(end / 1000)), len(shards), self.workers)
+
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='backfill') as pool:
+            futures = {pool.submit(self.fetch_shard, shard): shard for shard in shards}
+            for future in as_completed(futures):
+                shard = futures[future]
+                try:
+                    self.enqueue(shard.cam, future.result())
+                except Exception as e:
+                    _LOGGER.error('门铃 %s 分片 %s 补齐失败: %s', shard.cam.name,
+                                  time.strftime('%m-%d %H:%M', time.localtime(shard.start / 1000)), e)
+                self._done += 1
+                self.report()
+
+        _LOGGER.info('补齐完成: 用时%s, %d个分片, %d页, 发现%d条事件, 新加入下载队列%d条',
+                     format_seconds(time.monotonic() - self._started), self._total, self._pages,
+                     self._found, self._queued)
+        return self._queued
+
+    def fetch_shard(self, shard: Shard) -> List[DoorbellEvent]:
+        cam = shard.cam
+        api, rqd = cam.event_list_request(shard.start, shard.end)
+        events = []
+        is_continue = True
+        next_time = shard.end
+        while is_continue:
+            rqd['endTime'] = next_time
+            rqd['limit'] = limit = self.page_size.size
+            page, is_continue, next_time = self.fetch_page(cam, api, rqd)
+            events.extend(page)
+            with self._lock:
+                self._pages += 1
+            # 整页返回说明事件较密集，加大分页减少请求次数
+            if is_continue and len(page) >= limit:
+                self.page_size.grow()
+        return events
+
+    def fetch_page(self, cam: MiDoorbell, api, rqd):
+        delay = PAGE_RETRY_DELAY
+        for attempt in range(PAGE_RETRIES + 1):
+            rdt = cam.xiaomi_cloud.request_miot_api(api, rqd, method='GET', crypt=True)
+            if rdt and rdt.get('code', 0) == 0 and 'isContinue' in (rdt.get('data') or {}):
+                return cam.parse_event_page(rdt)
+            if attempt == PAGE_RETRIES:
+                break
+            # 请求失败时减小分页并等待后重试，避免大分页超时或被限流
+            self.page_size.shrink()
+            rqd['limit'] = self.page_size.size
+            _LOGGER.debug('门铃 %s 事件列表请求失败，%ds后以分页大小%d重试: %s', cam.name, delay, rqd['limit'], rdt)
+            time.sleep(delay)
+            delay *= 2
+        raise Exception(f'事件列表请求失败: {rdt}')
+
+    def enqueue(self, cam: MiDoorbell, events: List[DoorbellEvent]):
+        # 相邻分片重叠的部分按fileId去重
+        with self._lock:
+            events = [e for e in events if e.fileId not in self._seen]
+            self._seen.update(e.fileId for e in events)
+            self._found += len(events)
+        queued = 0
+        for event in self.history.filter_new(cam.name, events):
+            if self.history.enqueue(cam.name, cam.miot_did, cam.model, event):
+                metrics.EVENTS_FOUND.inc(door=cam.name)
+                queued += 1
+        with self._lock:
+            self._queued += queued
+        if queued and self.on_enqueue:
+            self.on_enqueue()
+
+    def report(self):
+        now = time.monotonic()
+        if self._done < self._total and now - self._last_report < PROGRESS_INTERVAL:
+            return
+        self._last_report = now
+        elapsed = now - self._started
+        remaining = elapsed / self._done * (self._total - self._done) if self._done else 0
+        _LOGGER.info('补齐进度: %d/%d个分片(%.0f%%), 发现%d条事件, 新加入下载队列%d条, 分页大小%d, 已用%s, 预计剩余%s',
+                     self._done, self._total, self._done * 100 / self._total, self._found, self._queued,
+                     self.page_size.size, format_seconds(elapsed), format_seconds(remaining))
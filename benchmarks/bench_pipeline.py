@@ -0,0 +1,166 @@
+"""End-to-end throughput benchmark against the local stub cloud.
+
+Starts benchmarks/stub_cloud.py in-process, then for every stub door runs
+get_event_list and downloads all events with MiDoorbell.download_video,
+exactly as the archiver does. Reports events/sec, segments/sec, MB/s and
+per-stage latency (get_event_list, download_video including its merge, and
+the merge on its own). Pass --json to get a machine readable result for
+comparing runs.
+
+    python benchmarks/bench_pipeline.py --events 20 --latency-ms 30 --bandwidth-mbps 50
+    python benchmarks/bench_pipeline.py --ffmpeg ffmpeg --pipeline pipe
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from doorbell import MiDoorbell, PIPELINES, run_ffmpeg  # noqa: E402
+from stub_cloud import StubCloud, StubServer  # noqa: E402
+from xiaomi_cloud import MiotCloud  # noqa: E402
+
+
+class Timings:
+    def __init__(self):
+        self.samples = {}
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        with self._lock:
+            self.samples.setdefault(stage, []).append(seconds)
+
+    def summary(self):
+        result = {}
+        for stage, values in self.samples.items():
+            values = sorted(values)
+            result[stage] = {
+                'count': len(values),
+                'mean_ms': statistics.mean(values) * 1000,
+                'p50_ms': values[len(values) // 2] * 1000,
+                'p95_ms': values[min(len(values) - 1, int(len(values) * 0.95))] * 1000,
+                'max_ms': values[-1] * 1000,
+            }
+        return result
+
+
+class InlineMerger:
+    """Stands in for merger.MergePool: runs the merge synchronously and times it separately."""
+
+    def __init__(self, timings: Timings):
+        self.timings = timings
+
+    def run_ffmpeg(self, cmd, cwd):
+        return run_ffmpeg(cmd, cwd)
+
+    def submit(self, key, fn, *args, **kwargs):
+        future = Future()
+        start = time.perf_counter()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        self.timings.add('merge', time.perf_counter() - start)
+        return future
+
+
+def run(args):
+    stub = StubCloud(
+        doors=[f'door{i}' for i in range(args.doors)],
+        events_per_door=args.events,
+        segments_per_event=args.segments,
+        segment_size=args.segment_kb * 1024,
+        latency=args.latency_ms / 1000,
+        bandwidth=int(args.bandwidth_mbps * 1e6 / 8),
+    )
+    server = StubServer(stub).start()
+    save_path = tempfile.mkdtemp(prefix='bench-')
+    timings = Timings()
+    merger = InlineMerger(timings)
+    try:
+        cloud = StubCloud.login(MiotCloud('bench', 'bench', api_base=server.base_url,
+                                          pool_size=args.concurrency * args.workers))
+        cams = [MiDoorbell(cloud, d['name'], d['did'], d['model']) for d in cloud.get_device_list()]
+
+        start = time.perf_counter()
+        jobs = []
+        for cam in cams:
+            t = time.perf_counter()
+            events = cam.get_event_list()
+            timings.add('get_event_list', time.perf_counter() - t)
+            jobs += [(cam, event) for event in events]
+
+        def download(job):
+            cam, event = job
+            t = time.perf_counter()
+            result = cam.download_video(event, save_path, bool(args.ffmpeg), args.ffmpeg,
+                                        workers=args.workers, merge_profile=args.merge_profile,
+                                        pipeline=args.pipeline, merger=merger)
+            if isinstance(result, Future):
+                result.result()
+            timings.add('download_video', time.perf_counter() - t)
+
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            list(pool.map(download, jobs))
+        elapsed = time.perf_counter() - start
+    finally:
+        server.stop()
+        shutil.rmtree(save_path, ignore_errors=True)
+
+    segments = len(jobs) * args.segments
+    payload = segments * stub.segment_size
+    return {
+        'config': vars(args),
+        'elapsed_s': elapsed,
+        'events': len(jobs),
+        'events_per_s': len(jobs) / elapsed,
+        'segments_per_s': segments / elapsed,
+        'mb_per_s': payload / 1e6 / elapsed,
+        'requests': stub.stats['requests'],
+        'stages': timings.summary(),
+    }
+
+
+def print_report(result):
+    print(f"{result['events']} events in {result['elapsed_s']:.2f}s, {result['requests']} requests")
+    print(f"  events/s   {result['events_per_s']:>10.2f}")
+    print(f"  segments/s {result['segments_per_s']:>10.2f}")
+    print(f"  MB/s       {result['mb_per_s']:>10.2f}")
+    print(f"  {'stage':<16}{'count':>6}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}{'max ms':>10}")
+    for stage, s in result['stages'].items():
+        print(f"  {stage:<16}{s['count']:>6}{s['mean_ms']:>10.1f}{s['p50_ms']:>10.1f}"
+              f"{s['p95_ms']:>10.1f}{s['max_ms']:>10.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--doors', type=int, default=1)
+    parser.add_argument('--events', type=int, default=20, help='events per door')
+    parser.add_argument('--segments', type=int, default=5, help='segments per event')
+    parser.add_argument('--segment-kb', type=int, default=256)
+    parser.add_argument('--latency-ms', type=float, default=0)
+    parser.add_argument('--bandwidth-mbps', type=float, default=0, help='per connection, 0 = unlimited')
+    parser.add_argument('--workers', type=int, default=4, help='download_workers per event')
+    parser.add_argument('--concurrency', type=int, default=2, help='events downloaded in parallel')
+    parser.add_argument('--pipeline', choices=PIPELINES, default='segments')
+    parser.add_argument('--ffmpeg', help='ffmpeg binary; merge step is skipped when omitted')
+    parser.add_argument('--merge-profile', default='copy')
+    parser.add_argument('--json', action='store_true', help='print the result as json')
+    args = parser.parse_args()
+
+    result = run(args)
+    if args.json:
+        print(json.dumps(result, indent=2, ensure_ascii=False))
+    else:
+        print_report(result)
+
+
+if __name__ == '__main__':
+    main()
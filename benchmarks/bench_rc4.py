@@ -0,0 +1,45 @@
+"""Micro benchmark: legacy RC4 class vs rc4_crypt used by MiotCloud.
+
+    python benchmarks/bench_rc4.py
+"""
+import base64
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from xiaomi_cloud import RC4, rc4_crypt  # noqa: E402
+
+
+def legacy_crypt(key, data):
+    return RC4(key).init1024().crypt(data)
+
+
+def bench(name, fun, key, data, number):
+    sec = timeit.timeit(lambda: fun(key, data), number=number) / number
+    print(f'  {name:<14}{sec * 1e6:>12.1f} us/op')
+    return sec
+
+
+def main():
+    key = base64.b64decode(base64.b64encode(os.urandom(32)))
+    cases = [
+        ('param (64B)', os.urandom(64), 2000),
+        ('page (16KB)', os.urandom(16 * 1024), 50),
+        ('list (256KB)', os.urandom(256 * 1024), 5),
+    ]
+    engines = [('legacy', legacy_crypt), ('ARC4', rc4_crypt)]
+    for title, data, number in cases:
+        expected = legacy_crypt(key, data)
+        for name, fun in engines[1:]:
+            assert fun(key, data) == expected, name
+        print(title)
+        base = bench(*engines[0], key, data, number)
+        for name, fun in engines[1:]:
+            sec = bench(name, fun, key, data, number)
+            print(f'  {"":<14}{base / sec:>12.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,223 @@
+"""Local stand-in for the xiaomi cloud endpoints used by the archiver.
+
+Implements the RC4 encrypted home/device_list, common/app/get/eventlist and
+common/app/m3u8 apis, plus AES-128-CBC encrypted ts segments and their key
+uri. Point a client at it with MiotCloud(..., api_base=server.base_url) and
+``StubCloud.login(cloud)``. Every response can be delayed by a fixed latency
+and streamed at a capped per-connection bandwidth to mimic a real uplink.
+
+    python benchmarks/stub_cloud.py --port 8000 --latency-ms 50 --bandwidth-mbps 20
+"""
+import argparse
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Crypto.Cipher import AES  # noqa: E402
+from micloud import miutils  # noqa: E402
+
+from xiaomi_cloud import MiotCloud  # noqa: E402
+
+SSECURITY = 'c3R1Yi1zc2VjdXJpdHktMDAwMA=='
+SERVICE_TOKEN = 'stub-service-token'
+USER_ID = '1000'
+DOORBELL_MODEL = 'madv.cateye.stub'
+TS_PACKET = 188
+WRITE_CHUNK = 64 * 1024
+
+
+class StubCloud:
+    def __init__(self, doors=('门铃',), events_per_door=20, segments_per_event=5,
+                 segment_size=256 * 1024, event_interval=600, latency=0.0, bandwidth=0):
+        """latency: seconds added before every response; bandwidth: bytes/sec per connection, 0 = unlimited."""
+        self.doors = list(doors)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.segments_per_event = segments_per_event
+        self.segment_size = segment_size - segment_size % TS_PACKET
+        now = int(time.time() * 1000)
+        self.events = {}
+        for n, door in enumerate(self.doors):
+            did = str(100000 + n)
+            self.events[did] = [
+                {
+                    'createTime': now - i * event_interval * 1000,
+                    'fileId': f'{did}-{i}',
+                    'eventType': 'Pass',
+                }
+                for i in range(events_per_door)
+            ]
+        self.stats = {'requests': 0, 'bytes': 0}
+        self._lock = threading.Lock()
+        self._payload = {}
+
+    @staticmethod
+    def login(cloud: MiotCloud):
+        """Give a MiotCloud the credentials the stub expects, without any network login."""
+        cloud.user_id = USER_ID
+        cloud.ssecurity = SSECURITY
+        cloud.service_token = SERVICE_TOKEN
+        cloud.token_time = time.time()
+        return cloud
+
+    def devices(self):
+        return [
+            {'name': door, 'did': str(100000 + n), 'model': DOORBELL_MODEL}
+            for n, door in enumerate(self.doors)
+        ]
+
+    def event_page(self, rqd):
+        did = str(rqd['did'])
+        begin, end, limit = int(rqd['beginTime']), int(rqd['endTime']), int(rqd.get('limit') or 10)
+        matched = [e for e in self.events.get(did, []) if begin <= e['createTime'] <= end]
+        page = matched[:limit]
+        more = len(matched) > limit
+        return {
+            'code': 0,
+            'data': {
+                'isContinue': more,
+                'nextTime': page[-1]['createTime'] - 1 if more else begin,
+                'thirdPartPlayUnits': page,
+            },
+        }
+
+    def key(self, fid):
+        return hashlib.md5(f'key-{fid}'.encode()).digest()
+
+    def iv(self, fid):
+        return hashlib.md5(f'iv-{fid}'.encode()).digest()
+
+    def playlist(self, base, fid):
+        lines = [
+            '#EXTM3U',
+            '#EXT-X-VERSION:3',
+            '#EXT-X-TARGETDURATION:2',
+            f'#EXT-X-KEY:METHOD=AES-128,URI="{base}/key/{fid}",IV=0x{self.iv(fid).hex()}',
+        ]
+        for i in range(self.segments_per_event):
+            lines += ['#EXTINF:2.000,', f'{base}/seg/{fid}/{i}.ts']
+        lines.append('#EXT-X-ENDLIST')
+        return '\n'.join(lines).encode()
+
+    def segment(self, fid, index):
+        """Encrypted segment made of dummy ts packets, cached since every event shares the content."""
+        with self._lock:
+            plain = self._payload.get(self.segment_size)
+            if plain is None:
+                packet = b'\x47' + bytes(TS_PACKET - 1)
+                plain = packet * (self.segment_size // TS_PACKET)
+                plain += bytes(16 - len(plain) % 16) if len(plain) % 16 else b''
+                self._payload[self.segment_size] = plain
+        return AES.new(self.key(fid), AES.MODE_CBC, self.iv(fid)).encrypt(plain)
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'StubCloud/1.0'
+
+    @property
+    def stub(self) -> StubCloud:
+        return self.server.stub
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.route(parse_qs(urlparse(self.path).query))
+
+    def do_POST(self):
+        size = int(self.headers.get('Content-Length') or 0)
+        self.route(parse_qs(self.rfile.read(size).decode()))
+
+    def route(self, query):
+        path = urlparse(self.path).path
+        base = self.server.base_url
+        if path == '/app/home/device_list':
+            return self.send_rc4(query, lambda rqd: {'code': 0, 'result': {'list': self.stub.devices()}})
+        if path == '/common/app/get/eventlist':
+            return self.send_rc4(query, self.stub.event_page)
+        if path == '/common/app/m3u8':
+            rqd = self.decrypt(query)
+            return self.send_body(self.stub.playlist(base, rqd['fileId']), 'application/vnd.apple.mpegurl')
+        if path.startswith('/key/'):
+            return self.send_body(self.stub.key(path[5:]), 'application/octet-stream')
+        if path.startswith('/seg/'):
+            fid, name = path[5:].rsplit('/', 1)
+            return self.send_body(self.stub.segment(fid, int(name[:-3])), 'video/mp2t')
+        self.send_body(b'{"code":-1,"message":"not found"}', 'application/json', status=404)
+
+    def decrypt(self, query):
+        nonce = miutils.signed_nonce(SSECURITY, query['_nonce'][0])
+        return json.loads(MiotCloud.decrypt_data(nonce, query['data'][0]))
+
+    def send_rc4(self, query, handler):
+        nonce = miutils.signed_nonce(SSECURITY, query['_nonce'][0])
+        rqd = json.loads(MiotCloud.decrypt_data(nonce, query['data'][0]))
+        body = MiotCloud.encrypt_data(nonce, json.dumps(handler(rqd)))
+        self.send_body(body.encode(), 'text/plain')
+
+    def send_body(self, body, content_type, status=200):
+        with self.stub._lock:
+            self.stub.stats['requests'] += 1
+            self.stub.stats['bytes'] += len(body)
+        if self.stub.latency:
+            time.sleep(self.stub.latency)
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if not self.stub.bandwidth:
+            self.wfile.write(body)
+            return
+        start = time.perf_counter()
+        view = memoryview(body)
+        for offset in range(0, len(body), WRITE_CHUNK):
+            self.wfile.write(view[offset:offset + WRITE_CHUNK])
+            ahead = (offset + WRITE_CHUNK) / self.stub.bandwidth - (time.perf_counter() - start)
+            if ahead > 0:
+                time.sleep(ahead)
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, stub: StubCloud, host='127.0.0.1', port=0):
+        super().__init__((host, port), StubHandler)
+        self.stub = stub
+        self.base_url = f'http://{host}:{self.server_port}'
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name='stub-cloud', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--doors', nargs='+', default=['门铃'])
+    parser.add_argument('--events', type=int, default=20)
+    parser.add_argument('--latency-ms', type=float, default=0)
+    parser.add_argument('--bandwidth-mbps', type=float, default=0, help='per connection, 0 = unlimited')
+    args = parser.parse_args()
+    stub = StubCloud(args.doors, args.events, latency=args.latency_ms / 1000,
+                     bandwidth=int(args.bandwidth_mbps * 1e6 / 8))
+    server = StubServer(stub, port=args.port)
+    print(f'stub cloud listening on {server.base_url}')
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,85 @@
 import json
-from typing import NamedTuple, List
+from typing import NamedTuple, List, Union
 
 
 class Config(NamedTuple):
     username: str
     password: str
     save_path: str
+    # 门铃空闲时的最长检查间隔（分钟）
     schedule_minutes: int
     ffmpeg: str
     merge: bool
     door_names: List[str]
     wechat_webhook: str
+    # 已处理事件的SQLite数据库，首次启动时自动导入旧版data.json
+    history_db: str = './data/history.db'
+    # 没有历史记录或全量扫描(--rescan)时获取的事件时间窗口（小时）
+    event_window_hours: float = 24
+    # 增量获取时相对已处理最新事件回溯的秒数，避免遗漏云端延迟入库的事件
+    event_overlap_seconds: int = 300
+    # 门铃有新事件后的检查间隔（秒），空闲时每次按poll_backoff倍数退避到schedule_minutes
+    poll_min_seconds: int = 60
+    poll_backoff: float = 2.0
+    # 检查间隔的随机抖动比例，避免多个门铃同时请求
+    poll_jitter: float = 0.1
+    # 活跃时段，如[{"start": "07:00", "end": "23:00"}]，时段内空闲间隔最多poll_active_max_seconds秒（可用max_seconds单独指定），
+    # 退避到schedule_minutes只在时段之外进行
+    poll_active_hours: List[dict] = []
+    poll_active_max_seconds: float = 60
+    # 同时处理的门铃数量上限，每个门铃由独立线程处理
+    door_workers: int = 4
+    # 每个门铃并发下载视频分片的线程数
+    download_workers: int = 4
+    # 补齐(--backfill)云端保留期内事件时的分片时长（小时）、并发分片数及初始分页大小（按返回情况自动调整）
+    backfill_shard_hours: float = 6
+    backfill_workers: int = 4
+    backfill_page_size: int = 50
+    # 同时处理的下载任务数，失败的任务按job_retry_seconds起指数退避重试，最长间隔job_retry_max_seconds
+    job_workers: int = 2
+    job_retry_seconds: float = 60
+    job_retry_max_seconds: float = 3600
+    # 下载当前事件时提前获取播放列表和密钥的后续任务数（0为不预取）及预取线程数
+    prefetch_depth: int = 2
+    prefetch_workers: int = 2
+    # ffmpeg合并进程数，与下载并行进行；单次合并的超时时间（秒，0为不限）及nice优先级
+    merge_workers: int = 1
+    merge_timeout_seconds: float = 1800
+    merge_nice: int = 10
+    # 企业微信通知：合并window秒内的错误，两次发送至少间隔min_interval秒，队列满时丢弃
+    wechat_window_seconds: float = 30
+    wechat_min_interval_seconds: float = 60
+    wechat_queue_size: int = 1000
+    # Prometheus格式指标接口的监听端口（0为不启用）及地址
+    metrics_port: int = 0
+    metrics_host: str = '127.0.0.1'
+    # 性能分析：开启后每个检查周期采样所有线程的调用栈并记录分片级耗时明细（也可用--profile开启）
+    profile: bool = False
+    profile_dir: str = './data/profile'
+    profile_keep: int = 20
+    # 始终保留的最慢操作数量，每个周期结束时写入profile_dir/slow_ops.json
+    slow_ops: int = 20
+    # 把已结束日期的事件视频按门铃合并为每天一个MP4（带章节和.json索引，需要ffmpeg），日期结束rollup_delay_hours小时后合并
+    rollup: bool = False
+    rollup_delay_hours: float = 72
+    # 米家API请求（含m3u8）每秒次数及分片下载带宽（Mbps）的共享限额，0为不限；额度用完时等待而不是失败
+    api_rate_limit: float = 0
+    download_limit_mbps: float = 0
+    # 按时段的限额，如[{"start": "08:00", "end": "23:00", "api_rate": 2, "download_mbps": 8}]，未覆盖的时段使用上面的默认值
+    rate_limit_schedule: List[dict] = []
+    # 与米家云端及视频服务器之间的HTTP连接池大小，建议不小于door_workers * download_workers
+    http_pool_size: int = 16
+    # 米家登录凭据缓存文件，重启后无需重新登录
+    token_cache: str = './data/token.json'
+    # 凭据使用超过该小时数后在后台提前刷新
+    token_refresh_hours: float = 20
+    # 设备列表缓存文件及有效期（小时），找不到配置的门铃时会立即刷新
+    device_cache: str = './data/device_cache.json'
+    device_cache_hours: float = 24
+    # 视频合并方式：copy(无损封装)、transcode(转码为H264)或自定义ffmpeg输出参数
+    merge_profile: Union[str, List[str]] = 'copy'
+    # 分片处理方式：segments(逐个分片文件)、single(单个ts文件)、pipe(直接写入ffmpeg)
+    pipeline: str = 'segments'
 
 
 def from_file(path='config.json') -> Config:
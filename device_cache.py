@@ -0,0 +1,106 @@
+import json
+import logging
+import os
+import threading
+import time
+
+_LOGGER = logging.getLogger(__name__)
+
+# 米家智能门铃的设备型号前缀
+DOORBELL_MODEL_PREFIX = 'madv.cateye.'
+
+
+class DeviceCache:
+    """按名称和did索引的米家设备缓存，超过有效期或找不到设备时才重新拉取设备列表"""
+
+    def __init__(self, cloud=None, path='./data/device_cache.json', ttl=86400):
+        self.cloud = cloud
+        self.path = path
+        self.ttl = ttl
+        self.fetched_at = 0
+        self._by_did = {}
+        self._by_name = {}
+        self._lock = threading.RLock()
+        self.load()
+
+    @property
+    def expired(self):
+        return time.time() - self.fetched_at >= self.ttl
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return False
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                dat = json.load(f) or {}
+        except (OSError, ValueError) as e:
+            _LOGGER.warning('读取设备缓存失败: %s', e)
+            return False
+        with self._lock:
+            self._index(dat.get('devices') or [])
+            self.fetched_at = dat.get('fetched_at') or 0
+        return True
+
+    def save(self):
+        if not self.path:
+            return False
+        with self._lock:
+            dat = {'fetched_at': self.fetched_at, 'devices': list(self._by_did.values())}
+        tmp = f'{self.path}.tmp'
+        try:
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(dat, f, ensure_ascii=False, indent=2)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            _LOGGER.warning('保存设备缓存失败: %s', e)
+            return False
+        return True
+
+    def update(self, device_list):
+        """用完整的设备列表替换缓存，list_devices.py 也会调用此方法"""
+        with self._lock:
+            self._index(device_list)
+            self.fetched_at = time.time()
+        self.save()
+
+    def refresh(self):
+        device_list = self.cloud.get_device_list()
+        if device_list is None:
+            return False
+        _LOGGER.info('共获取到%d个设备', len(device_list))
+        self.update(device_list)
+        return True
+
+    def find(self, name, model_prefix=''):
+        with self._lock:
+            for device in self._by_name.get(name, []):
+                if device['model'].startswith(model_prefix):
+                    return device
+        return None
+
+    def find_doorbell(self, name):
+        """按名称查找门铃，缓存过期或未命中时刷新一次设备列表"""
+        with self._lock:
+            refreshed = False
+            if self.expired:
+                refreshed = self.refresh()
+            device = self.find(name, DOORBELL_MODEL_PREFIX)
+            if device is None and not refreshed:
+                _LOGGER.info('设备缓存中未找到 %s，重新获取设备列表', name)
+                if self.refresh():
+                    device = self.find(name, DOORBELL_MODEL_PREFIX)
+            return device
+
+    def _index(self, device_list):
+        self._by_did = {}
+        self._by_name = {}
+        for d in device_list:
+            device = {
+                'name': d['name'],
+                'did': str(d['did']),
+                'model': d['model'],
+            }
+            self._by_did[device['did']] = device
+            self._by_name.setdefault(device['name'], []).append(device)
@@ -4,15 +4,63 @@ import time
 from datetime import datetime
 import locale
 import binascii
+import hashlib
+import json
 import os
+import shlex
+import shutil
+import tempfile
+import threading
 
 import requests
 import subprocess
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from Crypto.Cipher import AES
 from typing import NamedTuple, List
 
+import metrics
+from profiling import PROFILER
+from ratelimit import LIMITER
+
 _LOGGER = logging.getLogger(__name__)
 
+# 米家云端免费存储的门铃视频保留天数
+CLOUD_RETENTION_DAYS = 3
+
+# 默认并发下载分片数
+DEFAULT_DOWNLOAD_WORKERS = 4
+# 流式解密时每次从网络读取的字节数
+SEGMENT_CHUNK_SIZE = 64 * 1024
+# 按顺序输出分片时，单个分片在内存中缓冲的上限，超出后落盘
+SEGMENT_SPOOL_SIZE = 4 * 1024 * 1024
+
+# 分片处理方式：
+# segments 每个分片保存为ts/N.ts，再用concat清单合并
+# single   所有分片按顺序写入同一个.ts文件
+# pipe     分片直接写入ffmpeg标准输入，不产生任何中间文件
+PIPELINES = ('segments', 'single', 'pipe')
+DEFAULT_PIPELINE = 'segments'
+
+# ffmpeg合并参数预设
+MERGE_PROFILES = {
+    # 无损封装：直接复制H265/AAC码流，ADTS格式的AAC需转换为MP4所需的ASC格式
+    'copy': ['-c', 'copy', '-bsf:a', 'aac_adtstoasc', '-movflags', '+faststart'],
+    # 转码为H264/AAC，兼容性最好但非常消耗CPU
+    'transcode': ['-c:v', 'libx264', '-c:a', 'aac'],
+}
+DEFAULT_MERGE_PROFILE = 'copy'
+
+# 每个事件在视频目录下的独立暂存目录：video_dir/.staging/<fileId>/
+STAGING_DIR = '.staging'
+
+# 分片目录中的下载清单，记录已校验的分片，中断后只下载缺失的分片
+MANIFEST_NAME = 'manifest.json'
+# 播放列表签名过期时视频服务器返回的状态码
+EXPIRED_STATUS = (401, 403, 410)
+# 按URI缓存的解密密钥数量，同一时段的视频常共用一个密钥
+KEY_CACHE_SIZE = 256
+
 
 class DoorbellEvent(NamedTuple):
     eventTime: int
@@ -47,16 +95,295 @@ class DoorbellEvent(NamedTuple):
         return '%s %s' % (self.date_time_fmt(), self.event_type_name())
 
 
+def merge_args(profile=DEFAULT_MERGE_PROFILE) -> List[str]:
+    """将合并配置转换为ffmpeg输出参数：预设名、自定义参数字符串或参数列表"""
+    if isinstance(profile, (list, tuple)):
+        return [str(arg) for arg in profile]
+    if not profile:
+        profile = DEFAULT_MERGE_PROFILE
+    if profile in MERGE_PROFILES:
+        return list(MERGE_PROFILES[profile])
+    return shlex.split(profile)
+
+
+def concat_cmd(ffmpeg, filelist_path, video_path, profile=DEFAULT_MERGE_PROFILE) -> List[str]:
+    # 使用绝对路径
+    return [
+        ffmpeg,
+        '-f', 'concat',
+        '-safe', '0',
+        '-i', filelist_path,
+        '-y',
+        *merge_args(profile),
+        video_path
+    ]
+
+
+def remux_cmd(ffmpeg, input_path, video_path, profile=DEFAULT_MERGE_PROFILE) -> List[str]:
+    # input_path为pipe:0时从标准输入读取
+    return [
+        ffmpeg,
+        '-f', 'mpegts',
+        '-i', input_path,
+        '-y',
+        *merge_args(profile),
+        video_path
+    ]
+
+
+def record_ffmpeg(seconds, result, cwd):
+    metrics.FFMPEG_SECONDS.observe(seconds, result=result)
+    PROFILER.record('ffmpeg', seconds, result=result, cwd=cwd)
+
+
+def run_ffmpeg(cmd, cwd, timeout=None, on_start=None):
+    """运行ffmpeg，超时后结束进程并抛出TimeoutExpired，on_start(proc)可用于登记进程以便取消"""
+    _LOGGER.debug('执行ffmpeg命令: %s', ' '.join(cmd))
+
+    # 设置环境变量以处理不同操作系统的编码
+    env = os.environ.copy()
+    if os.name == 'nt':  # Windows 环境
+        env['PYTHONIOENCODING'] = 'utf-8'
+        # 将命令列表转换为字符串，避免Windows的命令行参数解析问题
+        args = ' '.join(f'"{arg}"' if ' ' in arg else arg for arg in cmd)
+        shell = True
+    else:  # Linux/Docker 环境
+        args = cmd
+        shell = False
+
+    proc = subprocess.Popen(
+        args,
+        cwd=cwd,
+        env=env,
+        shell=shell,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        encoding='utf-8',
+        errors='replace'
+    )
+    if on_start:
+        on_start(proc)
+    start = time.perf_counter()
+    try:
+        stdout, stderr = proc.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        stdout, stderr = proc.communicate()
+        record_ffmpeg(time.perf_counter() - start, 'timeout', cwd)
+        raise subprocess.TimeoutExpired(cmd, timeout, output=stdout, stderr=stderr)
+    record_ffmpeg(time.perf_counter() - start, 'ok' if proc.returncode == 0 else 'error', cwd)
+
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(
+            proc.returncode,
+            cmd,
+            output=stdout,
+            stderr=stderr
+        )
+    return subprocess.CompletedProcess(cmd, proc.returncode, stdout, stderr)
+
+
+class VideoSegment(NamedTuple):
+    index: int
+    url: str
+    key: bytes
+    iv: bytes
+
+
+def parse_m3u8(lines):
+    """解析m3u8播放列表，按顺序返回 [(分片URL, 密钥URI, IV)]"""
+    items = []
+    key_uri = None
+    iv = None
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        # 解析密钥信息
+        if line.startswith('#EXT-X-KEY'):
+            start = line.index('URI="')
+            key_uri = line[start: line.index('"', start + 10)][5:]
+            iv = binascii.unhexlify(line[line.index('IV='):][5:])
+
+        # 解析视频URL
+        if line.startswith('http'):
+            items.append((line, key_uri, iv))
+    return items
+
+
+def publish_file(src, dst):
+    """同一文件系统内原子地将暂存文件移动到正式位置，不会出现写了一半的视频文件"""
+    os.replace(src, dst)
+    return dst
+
+
+def remove_staging(staging_path):
+    """删除事件的暂存目录，.staging已空时一并删除"""
+    shutil.rmtree(staging_path, ignore_errors=True)
+    try:
+        os.rmdir(os.path.dirname(staging_path))
+    except OSError:
+        pass
+
+
+class KeyCache:
+    """按URI缓存的AES密钥，最近最少使用的先淘汰，多个门铃和下载线程共享"""
+
+    def __init__(self, size=KEY_CACHE_SIZE):
+        self.size = size
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, uri):
+        with self._lock:
+            key = self._keys.get(uri)
+            if key is not None:
+                self._keys.move_to_end(uri)
+            return key
+
+    def put(self, uri, key):
+        with self._lock:
+            self._keys[uri] = key
+            self._keys.move_to_end(uri)
+            while len(self._keys) > self.size:
+                self._keys.popitem(last=False)
+
+
+KEY_CACHE = KeyCache()
+
+
+class ClipManifest:
+    """单个事件的分片下载清单：播放列表中的分片、密钥/IV，以及已下载分片的大小和sha256
+
+    fileId与当前事件不一致的清单直接丢弃；每个分片下载完成后立即原子写入，进程中断也不会丢失进度。
+    """
+
+    def __init__(self, path, file_id):
+        self.path = path
+        self.file_id = file_id
+        self.segments: List[VideoSegment] = []
+        self.done = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path, file_id):
+        manifest = cls(path, file_id)
+        try:
+            with open(path, encoding='utf-8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return manifest
+        except (OSError, ValueError) as e:
+            _LOGGER.warning('下载清单无法读取，重新下载: %s', e)
+            return manifest
+        if data.get('fileId') != file_id:
+            _LOGGER.info('下载清单属于其他事件 %s，已丢弃', data.get('fileId'))
+            return manifest
+        manifest.segments = [
+            VideoSegment(index=s['index'], url=s['url'], key=bytes.fromhex(s['key']), iv=bytes.fromhex(s['iv']))
+            for s in data.get('segments', [])
+        ]
+        manifest.done = {int(index): item for index, item in data.get('done', {}).items()}
+        return manifest
+
+    def set_segments(self, segments: List[VideoSegment]):
+        """写入(重新获取的)播放列表，分片数量变化时已下载的记录全部作废"""
+        with self._lock:
+            if len(segments) != len(self.segments):
+                self.done = {}
+            self.segments = list(segments)
+            self._save()
+
+    def mark_done(self, index, size, sha256):
+        with self._lock:
+            self.done[index] = {'size': size, 'sha256': sha256}
+            self._save()
+
+    def verified(self, path, index) -> bool:
+        """分片文件存在，且大小和sha256与清单记录一致"""
+        item = self.done.get(index)
+        if not item:
+            return False
+        try:
+            if os.path.getsize(path) != item['size']:
+                return False
+            digest = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(SEGMENT_CHUNK_SIZE), b''):
+                    digest.update(chunk)
+        except OSError:
+            return False
+        return digest.hexdigest() == item['sha256']
+
+    def _save(self):
+        data = {
+            'fileId': self.file_id,
+            'segments': [
+                {'index': seg.index, 'url': seg.url, 'key': seg.key.hex(), 'iv': seg.iv.hex()}
+                for seg in self.segments
+            ],
+            'done': {str(index): item for index, item in self.done.items()},
+        }
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.path)
+
+
+class SegmentDecryptor:
+    """流式AES-CBC解密，输入任意长度的密文块，输出块对齐的明文，缓冲区在整个分片内复用"""
+
+    def __init__(self, key, iv, chunk_size=SEGMENT_CHUNK_SIZE):
+        self.crypto = AES.new(key, AES.MODE_CBC, iv)
+        # 输入缓冲区额外预留一个块，用于保存上次未对齐的剩余字节
+        self.buf = bytearray(chunk_size + AES.block_size)
+        self.plain = bytearray(chunk_size + AES.block_size)
+        self.view = memoryview(self.buf)
+        self.plain_view = memoryview(self.plain)
+        self.pending = 0
+        self.size = 0
+        self.decrypt_seconds = 0.0
+
+    def feed(self, chunk):
+        """逐段产出解密后的明文，产出的memoryview在下一次迭代前有效"""
+        block = AES.block_size
+        view = self.view
+        offset = 0
+        while offset < len(chunk):
+            n = min(len(chunk) - offset, len(self.buf) - self.pending)
+            view[self.pending:self.pending + n] = chunk[offset:offset + n]
+            self.pending += n
+            offset += n
+            # 只解密块对齐的部分，剩余字节留到下一轮
+            aligned = self.pending - self.pending % block
+            if aligned:
+                start = time.perf_counter()
+                self.crypto.decrypt(view[:aligned], output=self.plain_view[:aligned])
+                self.decrypt_seconds += time.perf_counter() - start
+                self.size += aligned
+                yield self.plain_view[:aligned]
+                view[:self.pending - aligned] = view[aligned:self.pending]
+                self.pending -= aligned
+
+    def finish(self, url=''):
+        if self.pending:
+            raise ValueError(f'分片长度不是AES块大小的整数倍: {url}')
+        return self.size
+
+
 class MiDoorbell:
 
-    def __init__(self, xiaomi_cloud, name, did, model):
+    def __init__(self, xiaomi_cloud, name, did, model, session=None, key_cache=KEY_CACHE):
         self.xiaomi_cloud = xiaomi_cloud
         self.name = name
         self._state_attrs = {}
         self.miot_did = did
         self.model = model
+        # 分片和密钥下载复用云端API的连接池
+        self.http = session or xiaomi_cloud.http_session()
+        self.key_cache = key_cache
 
-    def get_event_list(self, start_time=None, end_time=None, limit=10) -> List[DoorbellEvent]:
+    def event_list_request(self, start_time=None, end_time=None, limit=10):
+        """构造事件列表接口地址和请求参数"""
         mic = self.xiaomi_cloud
         lag = locale.getlocale()[0]
         if start_time:
@@ -83,144 +410,198 @@ class MiDoorbell:
             'endTime': etm,
             'limit': limit,
         }
+        return api, rqd
+
+    @staticmethod
+    def parse_event_page(rdt):
+        """解析一页事件列表，返回(事件, 是否还有下一页, 下一页的endTime)"""
+        data = (rdt or {}).get('data', {})
+        rls = data.get('thirdPartPlayUnits') or []
+        events = [
+            DoorbellEvent(
+                eventTime=int(item['createTime']),
+                fileId=item['fileId'],
+                eventType=item['eventType'])
+            for item in rls
+        ]
+        return events, data['isContinue'], data['nextTime']
+
+    def get_event_list(self, start_time=None, end_time=None, limit=10) -> List[DoorbellEvent]:
+        mic = self.xiaomi_cloud
+        api, rqd = self.event_list_request(start_time, end_time, limit)
 
         all_list = []
         is_continue = True
-        next_time = etm
+        next_time = rqd['endTime']
 
         while is_continue:
             rqd['endTime'] = next_time
 
             rdt = mic.request_miot_api(api, rqd, method='GET', crypt=True) or {}
-            data = rdt.get('data', {})
-            is_continue = data['isContinue']
-            next_time = data['nextTime']
+            events, is_continue, next_time = self.parse_event_page(rdt)
+            all_list.extend(events)
 
-            rls = data.get('thirdPartPlayUnits') or []
+        return all_list
 
-            for item in rls:
-                all_list.append(DoorbellEvent(
-                    eventTime=int(item['createTime']),
-                    fileId=item['fileId'],
-                    eventType=item['eventType']))
+    def download_video(self, event: DoorbellEvent, save_path, merge=False, ffmpeg=None,
+                       workers=DEFAULT_DOWNLOAD_WORKERS, merge_profile=DEFAULT_MERGE_PROFILE,
+                       pipeline=DEFAULT_PIPELINE, on_stage=None, merger=None, prefetcher=None,
+                       merge_timeout=None):
+        """下载事件视频，分片下载完成、开始合并前调用on_stage('merging')
 
-        return all_list
+        指定merger(合并进程池)时，segments方式下载完成后将合并任务提交到merger并返回其Future，
+        调用方可以立即下载下一个事件；合并失败时Future抛出异常。
+        prefetcher中已提前获取的播放列表直接使用，省去签名、m3u8和密钥请求的等待。
+        merge_timeout为single/pipe方式中ffmpeg的超时时间（秒），merger中的合并使用merger自己的超时。
+        """
+        if pipeline not in PIPELINES:
+            raise ValueError(f'不支持的分片处理方式: {pipeline}')
+
+        video_dir, video_path, ts_path = self.video_paths(event, save_path)
+
+        # 确保所有必要的目录都存在
+        os.makedirs(video_dir, exist_ok=True)
+
+        _LOGGER.debug('视频目录: %s', video_dir)
+        _LOGGER.debug('最终视频路径: %s', video_path)
 
-    def download_video(self, event: DoorbellEvent, save_path, merge=False, ffmpeg=None):
-        m3u8_url = self.get_video_m3u8_url(event)
-        resp = requests.get(m3u8_url)
-        lines = resp.content.splitlines()
-        video_cnt = 0
-        key = None
-        iv = None
+        if pipeline == 'segments':
+            video_cnt = self.download_resumable(event, ts_path, workers, prefetcher)
+            if on_stage:
+                on_stage('merging')
+            if merger is not None and merge and ffmpeg:
+                return merger.submit(
+                    event.fileId, self.merge_segment_files, video_cnt, ts_path, video_path, merge, ffmpeg,
+                    merge_profile, runner=merger.run_ffmpeg, strict=True,
+                )
+            return self.merge_segment_files(video_cnt, ts_path, video_path, merge, ffmpeg, merge_profile)
+
+        segments = self.get_segments(event, prefetcher)
+        if pipeline == 'pipe' and merge and ffmpeg:
+            return self.pipe_to_ffmpeg(segments, video_path, ts_path, ffmpeg, workers, merge_profile, merge_timeout)
+        return self.save_single_ts(segments, video_path, ts_path, merge, ffmpeg, workers, merge_profile, on_stage,
+                                   merge_timeout)
+
+    def get_segments(self, event: DoorbellEvent, prefetcher=None) -> List[VideoSegment]:
+        """重新签名获取m3u8，返回分片列表；prefetcher中有该事件的有效结果时直接使用"""
+        if prefetcher is not None:
+            segments = prefetcher.take(event)
+            if segments is not None:
+                return segments
+        # m3u8接口与其他米家API共用请求额度
+        LIMITER.wait_api()
+        with metrics.M3U8_SECONDS.time(), PROFILER.timed('m3u8', door=self.name, fileId=event.fileId):
+            resp = self.http.get(self.get_video_m3u8_url(event))
+        resp.raise_for_status()
+        return self.parse_playlist(resp.content.splitlines())
+
+    def download_resumable(self, event: DoorbellEvent, ts_path, workers=DEFAULT_DOWNLOAD_WORKERS, prefetcher=None):
+        """按清单将分片下载到ts_path/N.ts，已校验的分片直接跳过，返回分片数"""
+        os.makedirs(ts_path, exist_ok=True)
+        _LOGGER.debug('TS目录: %s', ts_path)
 
+        manifest = ClipManifest.load(os.path.join(ts_path, MANIFEST_NAME), event.fileId)
+        if not manifest.segments:
+            manifest.set_segments(self.get_segments(event, prefetcher))
+
+        missing = [
+            seg for seg in manifest.segments
+            if not manifest.verified(os.path.join(ts_path, f'{seg.index}.ts'), seg.index)
+        ]
+        if len(missing) < len(manifest.segments):
+            _LOGGER.info('续传 %s：已校验%d个分片，需下载%d个',
+                         event.fileId, len(manifest.segments) - len(missing), len(missing))
+
+        expired = self.download_segments(missing, ts_path, manifest, workers)
+        if expired:
+            # 清单中的分片地址签名已过期，重新获取m3u8后只下载剩余分片
+            _LOGGER.info('播放列表签名已过期，重新获取后下载剩余%d个分片', len(expired))
+            manifest.set_segments(self.get_segments(event))
+            by_index = {seg.index: seg for seg in manifest.segments}
+            retry = [by_index[index] for index in expired if index in by_index]
+            if self.download_segments(retry, ts_path, manifest, workers):
+                raise Exception(f'重新获取播放列表后分片仍无法下载: {event.fileId}')
+        return len(manifest.segments)
+
+    def download_segments(self, segments, ts_path, manifest: ClipManifest, workers=DEFAULT_DOWNLOAD_WORKERS):
+        """并发下载分片并逐个记录到清单，返回因签名过期而失败的分片序号"""
+        expired = []
+        error = None
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            futures = {
+                pool.submit(self.download_segment, seg, os.path.join(ts_path, f'{seg.index}.ts')): seg
+                for seg in segments
+            }
+            # 其他分片出错时仍记录已完成的分片，下次只需下载剩余部分
+            for future in as_completed(futures):
+                seg = futures[future]
+                try:
+                    size, sha256 = future.result()
+                except requests.HTTPError as e:
+                    if e.response is not None and e.response.status_code in EXPIRED_STATUS:
+                        expired.append(seg.index)
+                    elif error is None:
+                        error = e
+                    continue
+                except Exception as e:
+                    if error is None:
+                        error = e
+                    continue
+                manifest.mark_done(seg.index, size, sha256)
+        if error is not None:
+            raise error
+        return sorted(expired)
+
+    def video_paths(self, event: DoorbellEvent, save_path):
+        """返回(视频目录, 最终视频路径, 暂存目录)，每个事件的暂存目录互不影响，同一天的视频可以并行处理"""
         # 新的路径结构：门铃名称/年月/日期/时间
         t = datetime.fromtimestamp(float(event.eventTime) / 1000)
         year_month = t.strftime('%Y%m')
         day = t.strftime('%y%m%d')
-        
+
         # 构建完整的视频保存路径
         video_dir = os.path.abspath(f"{save_path}/{self.name}/{year_month}/{day}")
         video_name = f"{event.short_time_fmt()}.mp4"
         video_path = os.path.join(video_dir, video_name)
-        ts_path = os.path.join(video_dir, "ts")
-        
-        # 确保所有必要的目录都存在
-        os.makedirs(video_dir, exist_ok=True)
-        os.makedirs(ts_path, exist_ok=True)
+        ts_path = os.path.join(video_dir, STAGING_DIR, str(event.fileId).replace(os.sep, '_'))
+        return video_dir, video_path, ts_path
 
-        _LOGGER.debug('视频目录: %s', video_dir)
-        _LOGGER.debug('TS目录: %s', ts_path)
-        _LOGGER.debug('最终视频路径: %s', video_path)
+    def merge_segment_files(self, video_cnt, ts_path, video_path, merge=False, ffmpeg=None,
+                            merge_profile=DEFAULT_MERGE_PROFILE, runner=run_ffmpeg, strict=False):
+        """将ts_path中的1.ts..N.ts合并为MP4，合并失败时保留分片目录并返回其路径，strict时改为抛出异常（包括没有分片时）
+
+        runner用于替换ffmpeg的执行方式，如合并进程池中带超时和优先级的执行。
+        """
+        video_dir = os.path.dirname(video_path)
+        # ffmpeg先输出到暂存目录，完整写入后再移动到正式位置
+        staged_path = os.path.join(ts_path, os.path.basename(video_path))
 
-        # 保存文件的同时，生成文件清单到filelist
+        # 按播放列表顺序生成文件清单到filelist，方便ffmpeg做视频合并
         with open(os.path.join(ts_path, 'filelist'), 'w', encoding='utf-8') as filelist:
-            for line in lines:
-                line = line.decode('utf-8')
-                # 解析密钥信息
-                if line.startswith('#EXT-X-KEY'):
-                    start = line.index('URI="')
-                    url = line[start: line.index('"', start + 10)][5:]
-                    key = requests.get(url).content
-                    iv = binascii.unhexlify(line[line.index('IV='):][5:])
-
-                # 解析视频URL并下载
-                if line.startswith('http'):
-                    r = requests.get(line)
-                    video_cnt += 1
-                    crypto = AES.new(key, AES.MODE_CBC, iv)
-                    filename = str(video_cnt) + '.ts'
-
-                    with open(os.path.join(ts_path, filename), 'wb') as f:
-                        f.write(crypto.decrypt(r.content))
-
-                    # 添加文件名到列表中，方便ffmpeg做视频合并
-                    filelist.writelines('file \'' + filename + '\'\n')
+            for i in range(1, video_cnt + 1):
+                filelist.write(f"file '{i}.ts'\n")
 
         if video_cnt > 0 and merge and ffmpeg:
             # 使用ffmpeg进行文件合并
             try:
-                # 生成相对路径的filelist文件
                 filelist_path = os.path.join(ts_path, 'filelist')
-                with open(filelist_path, 'w', encoding='utf-8') as f:
-                    for i in range(1, video_cnt + 1):
-                        f.write(f"file '{i}.ts'\n")
-
-                # 使用绝对路径
-                cmd = [
-                    ffmpeg,
-                    '-f', 'concat',
-                    '-safe', '0',
-                    '-i', filelist_path,
-                    '-y',
-                    '-c:v', 'libx264',
-                    '-c:a', 'aac',
-                    video_path
-                ]
-                _LOGGER.debug('执行ffmpeg命令: %s', ' '.join(cmd))
-                
-                # 设置环境变量以处理不同操作系统的编码
-                env = os.environ.copy()
-                if os.name == 'nt':  # Windows 环境
-                    env['PYTHONIOENCODING'] = 'utf-8'
-                    # 将命令列表转换为字符串，避免Windows的命令行参数解析问题
-                    cmd_str = ' '.join(f'"{arg}"' if ' ' in arg else arg for arg in cmd)
-                    result = subprocess.run(
-                        cmd_str,
-                        cwd=ts_path,
-                        env=env,
-                        shell=True,
-                        stdout=subprocess.PIPE,
-                        stderr=subprocess.PIPE,
-                        encoding='utf-8',
-                        errors='replace'
-                    )
-                else:  # Linux/Docker 环境
-                    result = subprocess.run(
-                        cmd,
-                        cwd=ts_path,
-                        env=env,
-                        stdout=subprocess.PIPE,
-                        stderr=subprocess.PIPE,
-                        encoding='utf-8',
-                        errors='replace'
-                    )
-
-                if result.returncode != 0:
-                    raise subprocess.CalledProcessError(
-                        result.returncode, 
-                        cmd,
-                        output=result.stdout,
-                        stderr=result.stderr
-                    )
-
-                _LOGGER.debug('ffmpeg输出: %s', result.stdout)
+
+                try:
+                    runner(concat_cmd(ffmpeg, filelist_path, staged_path, merge_profile), ts_path)
+                except subprocess.CalledProcessError as e:
+                    # 无损封装失败（如音频编码不兼容MP4）时回退为转码
+                    if merge_profile != 'copy':
+                        raise
+                    _LOGGER.warning('无损封装失败，改用转码合并: %s', e.stderr)
+                    runner(concat_cmd(ffmpeg, filelist_path, staged_path, 'transcode'), ts_path)
                 
                 # 检查输出文件是否存在且大小大于0
-                if os.path.exists(video_path) and os.path.getsize(video_path) > 0:
-                    # 合并成功后删除ts文件夹
-                    import shutil
-                    shutil.rmtree(ts_path)
+                if os.path.exists(staged_path) and os.path.getsize(staged_path) > 0:
+                    publish_file(staged_path, video_path)
+                    if not os.path.isfile(video_path):
+                        raise Exception(f'视频文件发布失败: {video_path}')
+                    # 合并成功后删除暂存目录
+                    remove_staging(ts_path)
                     _LOGGER.info('视频合并成功：%s', video_path)
                     return video_dir
                 else:
@@ -230,10 +611,242 @@ class MiDoorbell:
                 _LOGGER.error('视频合并失败: %s', e)
                 if hasattr(e, 'stderr'):
                     _LOGGER.error('ffmpeg错误输出: %s', e.stderr)
-                # 合并失败时保留ts文件夹
+                # 合并失败时保留暂存目录，重试时从清单续传
+                if strict:
+                    raise
                 return ts_path
 
-        return video_dir
+        if video_cnt == 0:
+            remove_staging(ts_path)
+            # 播放列表为空或已过期时没有视频，strict时抛出异常由下载任务重试，不能标记为完成
+            if strict:
+                raise Exception('播放列表中没有视频分片')
+            return video_dir
+        # 不合并时将分片目录整体移动到 视频目录/时间/ 下
+        segments_dir = os.path.splitext(video_path)[0]
+        shutil.rmtree(segments_dir, ignore_errors=True)
+        publish_file(ts_path, segments_dir)
+        remove_staging(ts_path)
+        return segments_dir
+
+    def save_single_ts(self, segments, video_path, staging_path, merge=False, ffmpeg=None,
+                       workers=DEFAULT_DOWNLOAD_WORKERS, merge_profile=DEFAULT_MERGE_PROFILE,
+                       on_stage=None, timeout=None):
+        """所有分片按顺序写入暂存目录中的同一个.ts文件，需要时再封装为MP4，ffmpeg超过timeout秒时结束"""
+        video_dir = os.path.dirname(video_path)
+        os.makedirs(staging_path, exist_ok=True)
+        ts_name = os.path.splitext(os.path.basename(video_path))[0] + '.ts'
+        staged_ts = os.path.join(staging_path, ts_name)
+        with open(staged_ts, 'wb') as f:
+            for spool in self.iter_segments(segments, workers):
+                shutil.copyfileobj(spool, f)
+
+        if not (segments and merge and ffmpeg):
+            publish_file(staged_ts, os.path.join(video_dir, ts_name))
+            remove_staging(staging_path)
+            return video_dir
+
+        if on_stage:
+            on_stage('merging')
+        staged_path = os.path.join(staging_path, os.path.basename(video_path))
+        try:
+            try:
+                run_ffmpeg(remux_cmd(ffmpeg, staged_ts, staged_path, merge_profile), staging_path, timeout)
+            except subprocess.CalledProcessError as e:
+                if merge_profile != 'copy':
+                    raise
+                _LOGGER.warning('无损封装失败，改用转码合并: %s', e.stderr)
+                run_ffmpeg(remux_cmd(ffmpeg, staged_ts, staged_path, 'transcode'), staging_path, timeout)
+
+            if os.path.exists(staged_path) and os.path.getsize(staged_path) > 0:
+                publish_file(staged_path, video_path)
+                remove_staging(staging_path)
+                _LOGGER.info('视频合并成功：%s', video_path)
+                return video_dir
+            raise Exception('视频文件创建失败或大小为0')
+        except Exception as e:
+            _LOGGER.error('视频合并失败: %s', e)
+            if hasattr(e, 'stderr'):
+                _LOGGER.error('ffmpeg错误输出: %s', e.stderr)
+            # 合并失败时保留ts文件
+            return staged_ts
+
+    def pipe_to_ffmpeg(self, segments, video_path, staging_path, ffmpeg,
+                       workers=DEFAULT_DOWNLOAD_WORKERS, merge_profile=DEFAULT_MERGE_PROFILE, timeout=None):
+        """解密后的分片直接写入ffmpeg标准输入，合并失败时没有可保留的中间文件
+
+        下载与封装同时进行，timeout秒（包括下载时间）后仍未结束时结束ffmpeg，写入会随之中断。
+        无损封装失败时与其他方式一样回退为转码，由于没有中间文件，需要重新下载分片。
+        """
+        video_dir = os.path.dirname(video_path)
+        if not segments:
+            return video_dir
+        os.makedirs(staging_path, exist_ok=True)
+        staged_path = os.path.join(staging_path, os.path.basename(video_path))
+        try:
+            try:
+                self.pipe_segments(segments, staged_path, ffmpeg, workers, merge_profile, timeout)
+            except subprocess.CalledProcessError as e:
+                if merge_profile != 'copy':
+                    raise
+                _LOGGER.warning('无损封装失败，重新下载分片并改用转码合并: %s', e.stderr)
+                self.pipe_segments(segments, staged_path, ffmpeg, workers, 'transcode', timeout)
+
+            if os.path.exists(staged_path) and os.path.getsize(staged_path) > 0:
+                publish_file(staged_path, video_path)
+                _LOGGER.info('视频合并成功：%s', video_path)
+                return video_dir
+            raise Exception('视频文件创建失败或大小为0')
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+            _LOGGER.error('视频合并失败: %s', e)
+            _LOGGER.error('ffmpeg错误输出: %s', e.stderr)
+        except requests.RequestException:
+            # 分片下载失败不是合并失败，与segments方式一样由调用方重试
+            raise
+        except OSError as e:
+            _LOGGER.error('视频合并失败: %s', e)
+        finally:
+            remove_staging(staging_path)
+        return None
+
+    def pipe_segments(self, segments, staged_path, ffmpeg, workers, merge_profile, timeout=None):
+        """下载分片并写入一个ffmpeg进程，失败时抛出CalledProcessError或TimeoutExpired"""
+        staging_path = os.path.dirname(staged_path)
+        cmd = remux_cmd(ffmpeg, 'pipe:0', staged_path, merge_profile)
+        _LOGGER.debug('执行ffmpeg命令: %s', ' '.join(cmd))
+        with tempfile.TemporaryFile() as err:
+            proc = subprocess.Popen(
+                cmd,
+                cwd=staging_path,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.DEVNULL,
+                stderr=err,
+            )
+            start = time.perf_counter()
+            # ffmpeg卡住时写入标准输入也会阻塞，由定时器结束进程；
+            # 先记录超时再结束进程，proc.wait()可能在定时器线程结束之前返回
+            killed = threading.Event()
+
+            def kill():
+                killed.set()
+                proc.kill()
+
+            watchdog = threading.Timer(timeout, kill) if timeout else None
+            if watchdog:
+                watchdog.daemon = True
+                watchdog.start()
+            try:
+                for spool in self.iter_segments(segments, workers):
+                    shutil.copyfileobj(spool, proc.stdin)
+                proc.stdin.close()
+            except BrokenPipeError:
+                # ffmpeg已提前退出，错误信息见返回码和stderr
+                pass
+            except BaseException:
+                proc.kill()
+                raise
+            finally:
+                returncode = proc.wait()
+                # 定时器触发时ffmpeg恰好正常结束的，不算超时
+                timed_out = killed.is_set() and returncode != 0
+                if watchdog:
+                    watchdog.cancel()
+            err.seek(0)
+            stderr = err.read().decode('utf-8', errors='replace')
+
+        seconds = time.perf_counter() - start
+        if timed_out:
+            record_ffmpeg(seconds, 'timeout', staging_path)
+            raise subprocess.TimeoutExpired(cmd, timeout, stderr=stderr)
+        record_ffmpeg(seconds, 'ok' if returncode == 0 else 'error', staging_path)
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, cmd, stderr=stderr)
+
+    def iter_segments(self, segments, workers=DEFAULT_DOWNLOAD_WORKERS):
+        """并发下载分片，并按播放列表顺序逐个产出解密后的内容"""
+        workers = max(1, workers)
+        remaining = iter(segments)
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            def submit_next():
+                seg = next(remaining, None)
+                if seg is not None:
+                    pending.append(pool.submit(self.spool_segment, seg))
+
+            # 最多预取两倍线程数的分片，限制缓冲占用
+            for _ in range(workers * 2):
+                submit_next()
+            try:
+                while pending:
+                    spool = pending.popleft().result()
+                    submit_next()
+                    with spool:
+                        spool.seek(0)
+                        yield spool
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    def spool_segment(self, seg: VideoSegment):
+        spool = tempfile.SpooledTemporaryFile(max_size=SEGMENT_SPOOL_SIZE)
+        try:
+            self.stream_segment(seg, spool)
+        except BaseException:
+            spool.close()
+            raise
+        return spool
+
+    def parse_playlist(self, lines) -> List[VideoSegment]:
+        """解析m3u8播放列表，返回按顺序编号的分片及其解密密钥，密钥按URI缓存"""
+        keys = {}
+        segments = []
+        for url, key_uri, iv in parse_m3u8(lines):
+            if key_uri not in keys:
+                keys[key_uri] = self.get_key(key_uri)
+            segments.append(VideoSegment(index=len(segments) + 1, url=url, key=keys[key_uri], iv=iv))
+        return segments
+
+    def get_key(self, key_uri):
+        key = self.key_cache.get(key_uri) if self.key_cache is not None else None
+        if key is None:
+            with metrics.KEY_SECONDS.time(), PROFILER.timed('key'):
+                resp = self.http.get(key_uri)
+            resp.raise_for_status()
+            key = resp.content
+            if self.key_cache is not None:
+                self.key_cache.put(key_uri, key)
+        return key
+
+    def download_segment(self, seg: VideoSegment, path):
+        """下载分片到path，写完后才替换为正式文件名，返回(大小, sha256)"""
+        digest = hashlib.sha256()
+        part_path = path + '.part'
+        with open(part_path, 'wb') as f:
+            size = self.stream_segment(seg, f, digest=digest)
+        os.replace(part_path, path)
+        return size, digest.hexdigest()
+
+    def stream_segment(self, seg: VideoSegment, out, chunk_size=SEGMENT_CHUNK_SIZE, digest=None):
+        """边下载边解密分片并写入out，内存占用与分片大小无关"""
+        start = time.perf_counter()
+        decryptor = SegmentDecryptor(seg.key, seg.iv, chunk_size)
+        with self.http.get(seg.url, stream=True) as r:
+            r.raise_for_status()
+            for chunk in r.iter_content(chunk_size):
+                # 下载带宽额度用完时在这里等待，读取变慢后服务器端的发送也随之放缓
+                LIMITER.wait_bytes(len(chunk))
+                for plain in decryptor.feed(chunk):
+                    out.write(plain)
+                    if digest is not None:
+                        digest.update(plain)
+        size = decryptor.finish(seg.url)
+        seconds = time.perf_counter() - start
+        metrics.SEGMENT_SECONDS.observe(seconds)
+        metrics.SEGMENT_BYTES.inc(size)
+        metrics.DECRYPT_SECONDS.observe(decryptor.decrypt_seconds)
+        PROFILER.record('segment', seconds, door=self.name, index=seg.index, bytes=size,
+                        decrypt=round(decryptor.decrypt_seconds, 6), url=seg.url.split('?', 1)[0])
+        return size
 
     def get_video_m3u8_url(self, event: DoorbellEvent):
         mic = self.xiaomi_cloud
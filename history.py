@@ -0,0 +1,261 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Iterable, List, NamedTuple, Optional
+
+from doorbell import DoorbellEvent, CLOUD_RETENTION_DAYS
+
+_LOGGER = logging.getLogger(__name__)
+
+SCHEMA_VERSION = 2
+
+# 下载任务状态
+STATE_PENDING = 'pending'
+STATE_DOWNLOADING = 'downloading'
+STATE_MERGING = 'merging'
+STATE_DONE = 'done'
+STATE_FAILED = 'failed'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS events (
+    door TEXT NOT NULL,
+    file_id TEXT NOT NULL,
+    event_time INTEGER NOT NULL,
+    event_type TEXT,
+    created_at REAL NOT NULL,
+    PRIMARY KEY (door, file_id)
+);
+CREATE INDEX IF NOT EXISTS idx_events_time ON events (event_time);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+'''
+
+# 按user_version依次执行的升级语句，旧记录视为已完成
+MIGRATIONS = {
+    2: '''
+ALTER TABLE events ADD COLUMN state TEXT NOT NULL DEFAULT 'done';
+ALTER TABLE events ADD COLUMN did TEXT;
+ALTER TABLE events ADD COLUMN model TEXT;
+ALTER TABLE events ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE events ADD COLUMN next_attempt REAL NOT NULL DEFAULT 0;
+ALTER TABLE events ADD COLUMN deadline REAL;
+ALTER TABLE events ADD COLUMN last_error TEXT;
+ALTER TABLE events ADD COLUMN updated_at REAL;
+CREATE INDEX IF NOT EXISTS idx_events_queue ON events (state, next_attempt);
+''',
+}
+
+
+class DownloadJob(NamedTuple):
+    door: str
+    did: str
+    model: str
+    event: DoorbellEvent
+    attempts: int
+    deadline: float
+
+
+class EventHistory:
+    """门铃事件的SQLite存储，每条事件单独写入，不再整体重写data.json
+
+    每条事件同时是一个持久化的下载任务：pending -> downloading -> merging -> done/failed。
+    同一个连接由多个门铃线程共享，所有读写都在锁内进行。
+    """
+
+    def __init__(self, path='./data/history.db'):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.RLock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        with self.conn:
+            self.conn.executescript(SCHEMA)
+        # SCHEMA为第1版表结构，新建的数据库从第1版开始升级
+        version = max(self.conn.execute('PRAGMA user_version').fetchone()[0], 1)
+        for v in range(version + 1, SCHEMA_VERSION + 1):
+            self.conn.executescript(f'BEGIN; {MIGRATIONS[v]} PRAGMA user_version={v}; COMMIT;')
+
+    def get_meta(self, key, default=None):
+        with self._lock:
+            row = self.conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_meta(self, key, value):
+        with self._lock, self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, str(value)))
+
+    def filter_new(self, door, events: Iterable[DoorbellEvent]) -> List[DoorbellEvent]:
+        """过滤掉已经处理过的事件"""
+        events = list(events)
+        seen = set()
+        # SQLite单条语句的参数个数有限，分批查询
+        for i in range(0, len(events), 500):
+            batch = [e.fileId for e in events[i:i + 500]]
+            with self._lock:
+                rows = self.conn.execute(
+                    'SELECT file_id FROM events WHERE door = ? AND file_id IN (%s)' % ','.join('?' * len(batch)),
+                    (door, *batch),
+                ).fetchall()
+            seen.update(r[0] for r in rows)
+        return [e for e in events if e.fileId not in seen]
+
+    def enqueue(self, door, did, model, event: DoorbellEvent) -> bool:
+        """新事件加入下载队列，截止时间为云端保留期限，已存在的事件返回False"""
+        now = time.time()
+        deadline = float(event.eventTime) / 1000 + CLOUD_RETENTION_DAYS * 86400
+        with self._lock, self.conn:
+            cur = self.conn.execute(
+                'INSERT OR IGNORE INTO events (door, file_id, event_time, event_type, created_at, '
+                'state, did, model, deadline, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (door, event.fileId, int(event.eventTime), event.eventType, now,
+                 STATE_PENDING, str(did), model, deadline, now),
+            )
+        return cur.rowcount > 0
+
+    def claim_job(self) -> Optional[DownloadJob]:
+        """领取一个到期的下载任务并标记为下载中，最早过期的任务优先"""
+        now = time.time()
+        with self._lock, self.conn:
+            row = self.conn.execute(
+                'SELECT door, file_id, event_time, event_type, did, model, attempts, deadline FROM events '
+                'WHERE state = ? AND next_attempt <= ? AND deadline > ? ORDER BY deadline LIMIT 1',
+                (STATE_PENDING, now, now),
+            ).fetchone()
+            if row is None:
+                return None
+            door, file_id, event_time, event_type, did, model, attempts, deadline = row
+            self.conn.execute(
+                'UPDATE events SET state = ?, attempts = attempts + 1, updated_at = ? '
+                'WHERE door = ? AND file_id = ?',
+                (STATE_DOWNLOADING, now, door, file_id),
+            )
+        event = DoorbellEvent(eventTime=event_time, fileId=file_id, eventType=event_type)
+        return DownloadJob(door, did, model, event, attempts + 1, deadline)
+
+    def peek_jobs(self, limit) -> List[DownloadJob]:
+        """按领取顺序查看接下来的到期任务，不改变状态，用于预取播放列表"""
+        now = time.time()
+        with self._lock:
+            rows = self.conn.execute(
+                'SELECT door, file_id, event_time, event_type, did, model, attempts, deadline FROM events '
+                'WHERE state = ? AND next_attempt <= ? AND deadline > ? ORDER BY deadline LIMIT ?',
+                (STATE_PENDING, now, now, limit),
+            ).fetchall()
+        return [
+            DownloadJob(door, did, model, DoorbellEvent(eventTime=event_time, fileId=file_id, eventType=event_type),
+                        attempts, deadline)
+            for door, file_id, event_time, event_type, did, model, attempts, deadline in rows
+        ]
+
+    def set_job_state(self, job: DownloadJob, state, error=None):
+        with self._lock, self.conn:
+            self.conn.execute(
+                'UPDATE events SET state = ?, last_error = ?, updated_at = ? WHERE door = ? AND file_id = ?',
+                (state, error, time.time(), job.door, job.event.fileId),
+            )
+
+    def retry_job(self, job: DownloadJob, error, delay) -> str:
+        """安排任务在delay秒后重试，重试时间超过截止时间时标记为失败，返回新状态"""
+        next_attempt = time.time() + delay
+        state = STATE_PENDING if next_attempt < job.deadline else STATE_FAILED
+        with self._lock, self.conn:
+            self.conn.execute(
+                'UPDATE events SET state = ?, next_attempt = ?, last_error = ?, updated_at = ? '
+                'WHERE door = ? AND file_id = ?',
+                (state, next_attempt, str(error), time.time(), job.door, job.event.fileId),
+            )
+        return state
+
+    def recover_jobs(self) -> int:
+        """进程重启后，把中断的下载中/合并中任务放回队列"""
+        with self._lock, self.conn:
+            cur = self.conn.execute(
+                'UPDATE events SET state = ?, next_attempt = 0 WHERE state IN (?, ?)',
+                (STATE_PENDING, STATE_DOWNLOADING, STATE_MERGING),
+            )
+        return cur.rowcount
+
+    def expire_jobs(self) -> int:
+        """已超过云端保留期限仍未完成的任务标记为失败"""
+        with self._lock, self.conn:
+            cur = self.conn.execute(
+                "UPDATE events SET state = ?, last_error = 'expired', updated_at = ? "
+                'WHERE state = ? AND deadline <= ?',
+                (STATE_FAILED, time.time(), STATE_PENDING, time.time()),
+            )
+        return cur.rowcount
+
+    def queue_depth(self) -> int:
+        with self._lock:
+            row = self.conn.execute(
+                'SELECT COUNT(*) FROM events WHERE state IN (?, ?, ?)',
+                (STATE_PENDING, STATE_DOWNLOADING, STATE_MERGING),
+            ).fetchone()
+        return row[0]
+
+    def active_jobs(self, door, begin, end) -> int:
+        """门铃在[begin, end)（毫秒）内尚未完成的下载任务数"""
+        with self._lock:
+            row = self.conn.execute(
+                'SELECT COUNT(*) FROM events WHERE door = ? AND event_time >= ? AND event_time < ? '
+                'AND state IN (?, ?, ?)',
+                (door, begin, end, STATE_PENDING, STATE_DOWNLOADING, STATE_MERGING),
+            ).fetchone()
+        return row[0]
+
+    def latest_event_time(self, door):
+        """门铃已处理的最新事件时间(毫秒)，没有记录时返回None"""
+        with self._lock:
+            row = self.conn.execute('SELECT MAX(event_time) FROM events WHERE door = ?', (door,)).fetchone()
+        return row[0]
+
+    def count(self, door=None) -> int:
+        with self._lock:
+            if door is None:
+                row = self.conn.execute('SELECT COUNT(*) FROM events').fetchone()
+            else:
+                row = self.conn.execute('SELECT COUNT(*) FROM events WHERE door = ?', (door,)).fetchone()
+        return row[0]
+
+    def migrate_json(self, data_path='./data.json'):
+        """一次性导入旧版data.json中的历史记录，UTF-8解码失败时按GBK读取"""
+        if self.get_meta('json_migrated') or not os.path.exists(data_path):
+            return 0
+        try:
+            with open(data_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except UnicodeDecodeError:
+            _LOGGER.warning('历史记录文件编码错误，尝试按GBK读取...')
+            try:
+                with open(data_path, 'r', encoding='gbk') as f:
+                    data = json.load(f)
+            except Exception as e:
+                _LOGGER.error('读取历史记录文件失败: %s', e)
+                return 0
+        except Exception as e:
+            _LOGGER.error('读取历史记录文件失败: %s', e)
+            return 0
+
+        now = time.time()
+        rows = []
+        for door, events in (data or {}).items():
+            for file_id, item in (events or {}).items():
+                rows.append((door, file_id, int(item.get('eventTime') or 0), item.get('eventType'), now))
+        with self._lock, self.conn:
+            self.conn.executemany(
+                'INSERT OR IGNORE INTO events (door, file_id, event_time, event_type, created_at) '
+                'VALUES (?, ?, ?, ?, ?)',
+                rows,
+            )
+            self.conn.execute(
+                'INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', ('json_migrated', data_path),
+            )
+        _LOGGER.info('已从 %s 导入%d条历史记录', data_path, len(rows))
+        return len(rows)
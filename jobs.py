@@ -0,0 +1,142 @@
+import logging
+import threading
+from concurrent.futures import Future, CancelledError
+
+import metrics
+from history import EventHistory, DownloadJob, STATE_DONE, STATE_FAILED
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class DownloadWorkers:
+    """从SQLite下载队列领取任务的工作线程
+
+    handler(job, on_stage) 下载单个事件视频，抛出异常即视为失败：按指数退避重试，
+    直到超过该事件在云端的保留期限才标记为失败。handler返回Future时（合并交给合并进程池），
+    下载线程立即领取下一个任务，Future完成后再更新任务状态。
+    每领取一个任务，把接下来的prefetch_depth个任务交给prefetch(jobs)提前准备播放列表。
+    任务状态都保存在数据库中，进程重启后继续处理。
+    """
+
+    def __init__(self, history: EventHistory, handler, workers=2, retry_base=60, retry_max=3600,
+                 poll_interval=30, prefetch=None, prefetch_depth=0):
+        self.history = history
+        self.handler = handler
+        self.prefetch = prefetch
+        self.prefetch_depth = prefetch_depth
+        self.workers = max(1, workers)
+        self.retry_base = retry_base
+        self.retry_max = max(retry_base, retry_max)
+        self.poll_interval = poll_interval
+        self._wakeup = threading.Condition()
+        self._stopped = False
+        self._threads = []
+        # 已提交到合并进程池、任务状态尚未更新的数量
+        self._merging = 0
+        self._merged_cond = threading.Condition()
+
+    def retry_delay(self, attempts):
+        return min(self.retry_base * 2 ** max(0, attempts - 1), self.retry_max)
+
+    def start(self):
+        recovered = self.history.recover_jobs()
+        if recovered:
+            _LOGGER.info('恢复%d个未完成的下载任务', recovered)
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._loop, name=f'download-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def wake(self):
+        with self._wakeup:
+            self._wakeup.notify_all()
+
+    def stop(self):
+        with self._wakeup:
+            self._stopped = True
+            self._wakeup.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def run_until_idle(self):
+        """处理当前所有到期的任务后返回，用于只检查一次的运行方式"""
+        self.history.recover_jobs()
+        threads = [threading.Thread(target=self._drain, name=f'download-{i}') for i in range(self.workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # 等待已提交到合并进程池的任务完成并写入状态；Future完成时回调可能还没执行，不能只等Future
+        with self._merged_cond:
+            self._merged_cond.wait_for(lambda: self._merging == 0)
+
+    def _drain(self):
+        while not self._stopped:
+            job = self.history.claim_job()
+            if job is None:
+                return
+            self._prefetch_next()
+            self._process(job)
+
+    def _loop(self):
+        while True:
+            self.history.expire_jobs()
+            self._drain()
+            with self._wakeup:
+                if self._stopped:
+                    return
+                self._wakeup.wait(self.poll_interval)
+
+    def _prefetch_next(self):
+        if not (self.prefetch and self.prefetch_depth > 0):
+            return
+        try:
+            self.prefetch(self.history.peek_jobs(self.prefetch_depth))
+        except Exception as e:
+            _LOGGER.debug('预取后续任务失败: %s', e)
+
+    def _process(self, job: DownloadJob):
+        def on_stage(state):
+            self.history.set_job_state(job, state)
+
+        try:
+            result = self.handler(job, on_stage)
+        except Exception as e:
+            self._failed(job, e)
+            return
+        if isinstance(result, Future):
+            with self._merged_cond:
+                self._merging += 1
+            result.add_done_callback(lambda future: self._merged(job, future))
+            return
+        self._done(job)
+
+    def _merged(self, job: DownloadJob, future: Future):
+        try:
+            future.result()
+        except CancelledError:
+            self._failed(job, Exception('合并任务已取消'))
+        except Exception as e:
+            self._failed(job, e)
+        else:
+            self._done(job)
+        finally:
+            with self._merged_cond:
+                self._merging -= 1
+                self._merged_cond.notify_all()
+
+    def _done(self, job: DownloadJob):
+        self.history.set_job_state(job, STATE_DONE)
+        metrics.JOBS.inc(result='done')
+
+    def _failed(self, job: DownloadJob, e):
+        delay = self.retry_delay(job.attempts)
+        state = self.history.retry_job(job, e, delay)
+        metrics.JOBS.inc(result='failed' if state == STATE_FAILED else 'retry')
+        if state == STATE_FAILED:
+            _LOGGER.error('门铃 %s 事件 %s 下载失败，已超过云端保留期限，放弃重试: %s',
+                          job.door, job.event.event_desc(), e)
+        else:
+            _LOGGER.warning('门铃 %s 事件 %s 第%d次下载失败，%d秒后重试: %s',
+                            job.door, job.event.event_desc(), job.attempts, delay, e)
@@ -5,6 +5,7 @@ from datetime import datetime
 
 import xiaomi_cloud
 import config
+from device_cache import DeviceCache
 
 # 基础配置
 logging.basicConfig(
@@ -21,7 +22,8 @@ def save_device_list():
         conf = config.from_file()
         
         # 登录米家账号
-        cloud = xiaomi_cloud.MiotCloud(username=conf.username, password=conf.password)
+        cloud = xiaomi_cloud.MiotCloud(username=conf.username, password=conf.password,
+                                       token_path=conf.token_cache)
         cloud.login()
         _LOGGER.info('登录米家账号成功')
 
@@ -29,6 +31,9 @@ def save_device_list():
         device_list = cloud.get_device_list()
         _LOGGER.info('共获取到%d个设备', len(device_list))
 
+        # 顺便刷新主程序使用的设备缓存
+        DeviceCache(path=conf.device_cache).update(device_list)
+
         # 按设备类型分类
         devices_by_type = {}
         for device in device_list:
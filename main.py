@@ -1,46 +1,25 @@
-import sys
+import argparse
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 
 import xiaomi_cloud
-from doorbell import MiDoorbell
+from doorbell import MiDoorbell, CLOUD_RETENTION_DAYS
+from device_cache import DeviceCache
+from history import EventHistory
+from scheduler import AdaptiveScheduler
+from jobs import DownloadWorkers
+from merger import MergePool
+from prefetch import PlaylistPrefetcher
+import metrics
+from profiling import PROFILER
+from ratelimit import LIMITER
+import rollup
 import config
-import schedule
-import time
-import json
 import os
+import threading
+import time
 import logging
-import requests
-
-class WeChatWebhookHandler(logging.Handler):
-    def __init__(self):
-        super().__init__()
-        self.webhook_url = conf.wechat_webhook
-        
-    def emit(self, record):
-        # 仅处理ERROR级别日志
-        if record.levelno >= logging.ERROR:
-            try:
-                # 格式化日志消息
-                msg = self.format(record)
-                
-                # 构造企业微信消息
-                data = {
-                    "msgtype": "text",
-                    "text": {
-                        "content": f"[ERROR]门铃存档机器人\n{msg}"
-                    }
-                }
-                
-                # 发送webhook请求
-                response = requests.post(
-                    self.webhook_url,
-                    json=data,
-                    timeout=5
-                )
-                response.raise_for_status()
-                
-            except Exception as e:
-                # 发送失败不影响原有日志记录
-                print(f"Failed to send WeChat notification: {str(e)}")
+from alerts import WeChatWebhookHandler
+from backfill import Backfill
 
 # 基础配置
 logging.basicConfig(
@@ -53,106 +32,316 @@ logging.basicConfig(
 _LOGGER = logging.getLogger(__name__)
 
 conf = config.from_file()
+PROFILER.configure(conf.profile_dir, conf.profile_keep, conf.slow_ops)
+LIMITER.configure(conf.api_rate_limit, conf.download_limit_mbps, conf.rate_limit_schedule)
+
+# 发送企业微信通知的logger；米家云端客户端的日志可能包含账号、密码哈希等登录参数，不发送
+ALERT_LOGGERS = (__name__, 'doorbell', 'jobs', 'merger', 'history', 'device_cache', 'backfill', 'prefetch',
+                 'rollup', 'scheduler')
+
+# 添加企业微信webhook handler，只处理ERROR级别，挂在ALERT_LOGGERS上
+# 发送在后台线程中进行，短时间内的错误合并、去重后再发送
+if conf.wechat_webhook:
+    wechat_handler = WeChatWebhookHandler(
+        conf.wechat_webhook,
+        window=conf.wechat_window_seconds,
+        min_interval=conf.wechat_min_interval_seconds,
+        max_queue=conf.wechat_queue_size,
+    )
+    for name in ALERT_LOGGERS:
+        logging.getLogger(name).addHandler(wechat_handler)
+
+# 米家云端客户端在多次轮询之间复用，登录凭据缓存在token_cache文件中
+_cloud = None
+_devices = None
+_history = None
+_workers = None
+_merge_pool = None
+_rollup_pool = None
+_prefetcher = None
+_init_lock = threading.Lock()
+
+
+def get_cloud():
+    global _cloud
+    with _init_lock:
+        if _cloud is None:
+            _cloud = xiaomi_cloud.MiotCloud(username=conf.username, password=conf.password,
+                                            pool_size=conf.http_pool_size, token_path=conf.token_cache)
+    return _cloud
+
+
+def get_device_cache():
+    global _devices
+    cloud = get_cloud()
+    with _init_lock:
+        if _devices is None:
+            _devices = DeviceCache(cloud, conf.device_cache, conf.device_cache_hours * 3600)
+    return _devices
+
+
+def get_history():
+    global _history
+    with _init_lock:
+        if _history is None:
+            _history = EventHistory(conf.history_db)
+            # 首次启动时导入旧版data.json中的记录
+            _history.migrate_json('./data.json')
+            metrics.QUEUE_DEPTH.set_function(_history.queue_depth, queue='download')
+    return _history
+
+
+def login_cloud():
+    """登录米家账号，已有有效凭据时不会重复登录"""
+    cloud = get_cloud()
+    if not cloud.login():
+        return None
+    cloud.start_token_refresher(conf.token_refresh_hours * 3600)
+    return cloud
+
+
+def event_begin_time(history, door_name, rescan=False):
+    """从已处理的最新事件时间（减去重叠时长）开始增量获取，没有记录或要求全量扫描时获取整个时间窗口"""
+    now = int(time.time() * 1000)
+    oldest = now - CLOUD_RETENTION_DAYS * 86400 * 1000
+    latest = None if rescan else history.latest_event_time(door_name)
+    if latest is None:
+        return max(oldest, now - int(conf.event_window_hours * 3600 * 1000))
+    # 停机较久时从上次记录处补齐，但不早于云端保留期限
+    return max(oldest, latest - conf.event_overlap_seconds * 1000)
+
+
+def process_door(cloud, devices, history, door_name, rescan=False):
+    """匹配单个门铃设备，获取新事件并加入下载队列，返回本次发现的事件数"""
+    _LOGGER.info('正在自动匹配智能门铃设备...，门铃设备名称为：%s', door_name)
+    device = devices.find_doorbell(door_name)
+
+    if not device:
+        _LOGGER.error('未找到名为 %s 的米家智能门铃', door_name)
+        return 0
+
+    cam = MiDoorbell(cloud, device['name'], device['did'], device['model'])
+    _LOGGER.info('匹配门铃设备成功，设备名称为:%s(%s)', cam.name, cam.model)
+
+    # 获取门铃事件列表(过滤历史已处理)
+    begin_time = event_begin_time(history, door_name, rescan)
+    event_list = history.filter_new(door_name, cam.get_event_list(start_time=begin_time))
+    _LOGGER.info('门铃 %s 本次共获取到%d条门铃事件', door_name, len(event_list))
+
+    # 新事件写入下载队列，由下载线程处理，失败时按退避重试
+    for event in event_list:
+        if history.enqueue(door_name, device['did'], device['model'], event):
+            metrics.EVENTS_FOUND.inc(door=door_name)
+    if event_list and _workers:
+        _workers.wake()
+    return len(event_list)
+
+
+def run_job(job, on_stage):
+    """下载线程处理单个队列任务，失败时抛出异常以便重试"""
+    cloud = login_cloud()
+    if not cloud:
+        raise Exception('登录米家账号失败')
+    cam = MiDoorbell(cloud, job.door, job.did, job.model)
+    _LOGGER.info('%s %s,视频下载中...', job.door, job.event.event_desc())
+
+    # 保存视频到指定文件
+    with PROFILER.cycle(f'job-{job.door}'):
+        path = cam.download_video(job.event, conf.save_path, conf.merge, conf.ffmpeg,
+                                  workers=conf.download_workers,
+                                  merge_profile=conf.merge_profile,
+                                  pipeline=conf.pipeline,
+                                  on_stage=on_stage,
+                                  merger=get_merge_pool(),
+                                  prefetcher=get_prefetcher(),
+                                  merge_timeout=conf.merge_timeout_seconds or None)
+    if isinstance(path, Future):
+        # 合并在合并进程池中进行，下载线程继续处理下一个任务
+        return path
+    if conf.merge and conf.ffmpeg:
+        _, video_path, _ = cam.video_paths(job.event, conf.save_path)
+        if not os.path.isfile(video_path):
+            # pipe方式没有中间文件，合并失败时不保留分片
+            raise Exception(f'视频合并失败，分片保留在 {path}' if path else '视频合并失败')
+    _LOGGER.info('视频已保存到：%s', path)
+
+
+def get_merge_pool():
+    global _merge_pool
+    with _init_lock:
+        if _merge_pool is None:
+            _merge_pool = MergePool(
+                workers=conf.merge_workers,
+                timeout=conf.merge_timeout_seconds,
+                nice=conf.merge_nice,
+            )
+            metrics.QUEUE_DEPTH.set_function(_merge_pool.pending, queue='merge')
+    return _merge_pool
+
+
+def get_rollup_pool():
+    """每日视频合并使用单独的单线程合并进程池，不占用事件视频的合并队列"""
+    global _rollup_pool
+    with _init_lock:
+        if _rollup_pool is None:
+            _rollup_pool = MergePool(workers=1, timeout=conf.merge_timeout_seconds, nice=rollup.NICE)
+    return _rollup_pool
+
+
+def get_prefetcher():
+    global _prefetcher
+    with _init_lock:
+        if _prefetcher is None:
+            _prefetcher = PlaylistPrefetcher(workers=conf.prefetch_workers, max_entries=max(8, conf.prefetch_depth * 4))
+    return _prefetcher
+
+
+def prefetch_jobs(jobs):
+    """下载当前事件的同时，为接下来的任务提前获取播放列表和密钥"""
+    cloud = get_cloud()
+    prefetcher = get_prefetcher()
+    for job in jobs:
+        prefetcher.prefetch(MiDoorbell(cloud, job.door, job.did, job.model), job.event)
 
-# 添加企业微信webhook handler
-wechat_handler = WeChatWebhookHandler()
-wechat_handler.setLevel(logging.ERROR)  # 只处理ERROR级别
-_LOGGER.addHandler(wechat_handler)
 
+def get_workers():
+    global _workers
+    history = get_history()
+    with _init_lock:
+        if _workers is None:
+            _workers = DownloadWorkers(
+                history,
+                run_job,
+                workers=conf.job_workers,
+                retry_base=conf.job_retry_seconds,
+                retry_max=conf.job_retry_max_seconds,
+                prefetch=prefetch_jobs,
+                prefetch_depth=conf.prefetch_depth,
+            )
+    return _workers
 
-def check_and_download():
+
+def backfill_doors(days=CLOUD_RETENTION_DAYS):
+    """停机后并行补齐所有门铃最近days天的事件并加入下载队列"""
+    cloud = login_cloud()
+    if not cloud:
+        _LOGGER.error('登录米家账号失败')
+        return 0
+    devices = get_device_cache()
+    cams = []
+    for door_name in valid_door_names():
+        device = devices.find_doorbell(door_name)
+        if not device:
+            _LOGGER.error('未找到名为 %s 的米家智能门铃', door_name)
+            continue
+        cams.append(MiDoorbell(cloud, door_name, device['did'], device['model']))
+
+    now = int(time.time() * 1000)
+    backfill = Backfill(
+        get_history(),
+        workers=conf.backfill_workers,
+        shard_hours=conf.backfill_shard_hours,
+        page_size=conf.backfill_page_size,
+        overlap_seconds=conf.event_overlap_seconds,
+        on_enqueue=_workers.wake if _workers else None,
+    )
+    return backfill.run(cams, now - int(min(days, CLOUD_RETENTION_DAYS) * 86400 * 1000), now)
+
+
+def rollup_archive():
+    """把已结束日期的视频按门铃合并为每天一个文件，在单独的合并进程池中以最低优先级运行"""
+    if not conf.ffmpeg:
+        _LOGGER.error('合并每日视频需要配置ffmpeg')
+        return 0
+    archive = rollup.ArchiveRollup(conf.save_path, conf.ffmpeg, conf.rollup_delay_hours, get_history())
+    pool = get_rollup_pool()
+    futures = {}
+    for door_name in valid_door_names():
+        for day_dir in archive.closed_days(door_name):
+            future = pool.submit(f'rollup-{day_dir}', archive.compact_day, door_name, day_dir,
+                                 runner=pool.run_ffmpeg)
+            futures[future] = day_dir
+    done = 0
+    for future in as_completed(futures):
+        try:
+            done += bool(future.result())
+        except Exception as e:
+            # 原视频保留，下次检查时重试
+            _LOGGER.error('合并每日视频失败 %s: %s', futures[future], e)
+    if futures:
+        _LOGGER.info('每日视频合并完成: %d/%d个日期', done, len(futures))
+    return done
+
+
+def rollup_forever():
+    while True:
+        try:
+            rollup_archive()
+        except Exception as e:
+            _LOGGER.error('合并每日视频出错:%s', e)
+        time.sleep(rollup.CHECK_INTERVAL)
+
+
+def valid_door_names():
+    door_names = []
+    for door_name in conf.door_names:
+        if not isinstance(door_name, str):
+            _LOGGER.error('门铃名称必须是字符串类型，当前类型: %s, 值: %s', type(door_name), door_name)
+            continue
+        door_names.append(door_name)
+    return door_names
+
+
+def check_door(door_name, rescan=False):
+    """调度器按门铃调用，返回本次发现的新事件数"""
+    cloud = login_cloud()
+    if not cloud:
+        raise Exception('登录米家账号失败')
+    found = process_door(cloud, get_device_cache(), get_history(), door_name, rescan)
+    _LOGGER.info('门铃 %s 检查完成', door_name)
+    # 指标是全局的，包括所有门铃和下载任务
+    _LOGGER.info('自上次汇总以来的全局指标: %s', metrics.REGISTRY.summary() or '无')
+    return found
+
+
+def check_and_download(rescan=False):
     try:
-        # 登录米家账号
-        cloud = xiaomi_cloud.MiotCloud(username=conf.username, password=conf.password)
-        cloud.login()
+        # 登录米家账号，已有有效凭据时不会重复登录
+        cloud = login_cloud()
+        if not cloud:
+            _LOGGER.error('登录米家账号失败')
+            return ''
         _LOGGER.info('登录米家账号成功')
 
-        # 获取米家设备列表
-        device_list = cloud.get_device_list()
-        _LOGGER.info('共获取到%d个设备', len(device_list))
-
-        # 读取已经处理过的视频，避免重复处理
-        data = {}
-        data_path = './data.json'
-        if os.path.exists(data_path):
-            try:
-                with open(data_path, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                _LOGGER.info('成功读取历史记录文件')
-            except UnicodeDecodeError:
-                # 如果UTF-8解码失败，尝试使用其他编码读取并重新保存为UTF-8
-                _LOGGER.warning('历史记录文件编码错误，尝试修复...')
+        # 米家设备列表按有效期缓存，找不到门铃时才重新获取
+        devices = get_device_cache()
+
+        # 已经处理过的视频记录在SQLite中，避免重复处理
+        history = get_history()
+
+        _LOGGER.info('配置的门铃列表: %s', conf.door_names)
+        door_names = valid_door_names()
+
+        # 每个门铃由独立的线程处理，一个门铃积压或出错不影响其他门铃
+        with ThreadPoolExecutor(max_workers=max(1, conf.door_workers)) as pool:
+            futures = {
+                pool.submit(process_door, cloud, devices, history, door_name, rescan): door_name
+                for door_name in door_names
+            }
+            for future in as_completed(futures):
                 try:
-                    with open(data_path, 'r', encoding='gbk') as f:
-                        data = json.load(f)
-                    # 立即以UTF-8重新保存
-                    with open(data_path, 'w', encoding='utf-8') as f:
-                        json.dump(data, f, ensure_ascii=False, indent=2)
-                    _LOGGER.info('历史记录文件已修复并重新保存为UTF-8编码')
+                    future.result()
                 except Exception as e:
-                    _LOGGER.error('修复历史记录文件失败: %s', e)
-                    data = {}
-            except Exception as e:
-                _LOGGER.error('读取历史记录文件失败: %s', e)
-                data = {}
+                    _LOGGER.error('门铃 %s 处理出错:%s', futures[future], e)
 
-        _LOGGER.info('配置的门铃列表: %s', conf.door_names)
-        
-        # 初始化每个门铃的历史记录
-        for door_name in conf.door_names:
-            if not isinstance(door_name, str):
-                _LOGGER.error('门铃名称必须是字符串类型，当前类型: %s, 值: %s', type(door_name), door_name)
-                continue
-                
-            if door_name not in data:
-                data[door_name] = {}
-                _LOGGER.info('为门铃 %s 初始化历史记录', door_name)
-
-        # 匹配多个智能门铃设备
-        for door_name in conf.door_names:
-            if not isinstance(door_name, str):
-                continue
-                
-            _LOGGER.info('正在自动匹配智能门铃设备...，门铃设备名称为：%s', door_name)
-            device = None
-            for d in device_list:
-                if d['model'].startswith('madv.cateye.') and d['name'] == door_name:
-                    device = d
-                    break
-
-            if not device:
-                _LOGGER.error('未找到名为 %s 的米家智能门铃', door_name)
-                continue
-
-            cam = MiDoorbell(cloud, device['name'], device['did'], device['model'])
-            _LOGGER.info('匹配门铃设备成功，设备名称为:%s(%s)', cam.name, cam.model)
-
-            # 获取门铃事件列表(过滤历史已处理)
-            event_list = [event for event in cam.get_event_list() 
-                         if event.fileId not in data[door_name]]
-            _LOGGER.info('门铃 %s 本次共获取到%d条门铃事件', door_name, len(event_list))
-
-            # 处理并下载视频
-            for event in event_list:
-                data[door_name][event.fileId] = event._asdict()
-
-                _LOGGER.info(event.event_desc() + ',视频下载中...')
-                
-                # 保存视频到指定文件
-                path = cam.download_video(event, conf.save_path, conf.merge, conf.ffmpeg)
-                _LOGGER.info('视频已保存到：%s', path)
-
-        # 存储已经处理过的记录
-        try:
-            with open(data_path, 'w', encoding='utf-8') as fp:
-                json.dump(data, fp, ensure_ascii=False, indent=2)
-            _LOGGER.info('历史记录已保存')
-        except Exception as e:
-            _LOGGER.error('保存历史记录失败: %s', e)
+        # 下载队列中所有到期的任务，失败的任务留在队列中等待下次运行
+        get_workers().run_until_idle()
 
         # 计算总处理数量
-        total_events = sum(len(door_data) for door_data in data.values())
-        _LOGGER.info('本次共处理完成, 历史总处理%d条门铃事件', total_events)
+        total_events = history.count()
+        _LOGGER.info('本次共处理完成, 历史总处理%d条门铃事件, 队列中剩余%d个任务',
+                     total_events, history.queue_depth())
+        _LOGGER.info('本次运行指标: %s', metrics.REGISTRY.summary() or '无')
 
     except Exception as e:
         _LOGGER.error('出错了:%s', e)
@@ -168,12 +357,66 @@ if __name__ == '__main__':
     # _LOGGER.error("This is an error message")
 
 
-    # 检查并下载视频
-    check_and_download()
+    parser = argparse.ArgumentParser(description='米家智能门铃视频存档')
+    parser.add_argument('--rescan', action='store_true',
+                        help='首次检查时忽略已处理的最新事件时间，重新扫描event_window_hours内的全部事件')
+    parser.add_argument('--once', action='store_true', help='检查并下载一次后退出')
+    parser.add_argument('--backfill', action='store_true',
+                        help='启动时并行补齐云端保留期内所有门铃的事件并加入下载队列，用于停机后恢复')
+    parser.add_argument('--rollup', action='store_true',
+                        help='把已结束日期的视频按门铃合并为每天一个文件后退出')
+    parser.add_argument('--profile', action='store_true',
+                        help='对每个检查周期采样分析，并记录分片级耗时明细到profile_dir')
+    args = parser.parse_args()
 
-    # 定时执行
-    schedule.every(conf.schedule_minutes).minutes.do(check_and_download)
+    if args.profile or conf.profile:
+        PROFILER.enable()
 
-    while True:
-        schedule.run_pending()
-        time.sleep(1)
+    # 可选的Prometheus指标接口
+    if conf.metrics_port:
+        metrics.start_http_server(conf.metrics_port, conf.metrics_host)
+
+    if args.rollup:
+        with PROFILER.cycle('rollup'):
+            rollup_archive()
+    elif args.once:
+        with PROFILER.cycle('once'):
+            if args.backfill:
+                backfill_doors()
+            check_and_download(rescan=args.rescan)
+            if conf.rollup:
+                rollup_archive()
+    else:
+        door_names = valid_door_names()
+        rescan_doors = set(door_names) if args.rescan else set()
+
+        def check(door_name):
+            rescan = door_name in rescan_doors
+            rescan_doors.discard(door_name)
+            with PROFILER.cycle(door_name):
+                return check_door(door_name, rescan)
+
+        # 下载线程持续处理队列，包括上次运行未完成的任务
+        get_workers().start()
+
+        if conf.rollup:
+            threading.Thread(target=rollup_forever, name='rollup', daemon=True).start()
+
+        # 补齐期间下载线程同时处理已加入队列的事件，最早的事件优先下载
+        if args.backfill:
+            with PROFILER.cycle('backfill'):
+                backfill_doors()
+
+        # 每个门铃独立调度：有新事件后按最小间隔检查，空闲时逐步退避到schedule_minutes，活跃时段内最多poll_active_max_seconds
+        scheduler = AdaptiveScheduler(
+            check,
+            door_names,
+            min_interval=conf.poll_min_seconds,
+            max_interval=conf.schedule_minutes * 60,
+            backoff=conf.poll_backoff,
+            jitter=conf.poll_jitter,
+            max_workers=conf.door_workers,
+            active_hours=conf.poll_active_hours,
+            active_max_interval=conf.poll_active_max_seconds,
+        )
+        scheduler.run_forever()
@@ -0,0 +1,131 @@
+import logging
+import os
+import queue
+import shutil
+import threading
+from concurrent.futures import Future
+
+from doorbell import run_ffmpeg
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class MergeCancelled(Exception):
+    pass
+
+
+class MergePool:
+    """独立于下载的ffmpeg合并队列
+
+    下载线程提交合并任务后立即处理下一个事件，网络下载与CPU合并同时进行。
+    每个ffmpeg进程有超时时间，并以较低的CPU/IO优先级运行；排队和运行中的任务都可以按key取消。
+    排队的任务达到上限时submit会阻塞，避免合并跟不上时暂存分片无限堆积。
+    """
+
+    def __init__(self, workers=1, timeout=1800, nice=10, idle_io=True, max_pending=None):
+        self.workers = max(1, workers)
+        self.timeout = timeout or None
+        self.prefix = self.priority_prefix(nice, idle_io)
+        self._queue = queue.Queue(maxsize=max_pending or self.workers * 2)
+        self._lock = threading.Lock()
+        self._futures = {}
+        self._procs = {}
+        self._cancelled = set()
+        self._local = threading.local()
+        self._threads = []
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._loop, name=f'merge-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    @staticmethod
+    def priority_prefix(nice, idle_io):
+        """Linux下用nice/ionice降低ffmpeg优先级，不影响下载和系统其他服务"""
+        if os.name == 'nt':
+            return []
+        prefix = []
+        if nice and shutil.which('nice'):
+            prefix += ['nice', '-n', str(nice)]
+        if idle_io and shutil.which('ionice'):
+            prefix += ['ionice', '-c', '3']
+        return prefix
+
+    def submit(self, key, fn, *args, **kwargs) -> Future:
+        """提交合并任务，fn中应通过self.run_ffmpeg调用ffmpeg，以便超时和取消生效"""
+        future = Future()
+        with self._lock:
+            self._futures[key] = future
+            self._cancelled.discard(key)
+        self._queue.put((key, fn, args, kwargs, future))
+        return future
+
+    def cancel(self, key):
+        """取消排队中的任务，或结束正在运行的ffmpeg进程"""
+        with self._lock:
+            future = self._futures.get(key)
+            if future is None:
+                return False
+            self._cancelled.add(key)
+            proc = self._procs.get(key)
+        if proc is not None:
+            proc.kill()
+        future.cancel()
+        return True
+
+    def shutdown(self, cancel=True):
+        if cancel:
+            with self._lock:
+                keys = list(self._futures)
+            for key in keys:
+                self.cancel(key)
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def pending(self):
+        with self._lock:
+            return len(self._futures)
+
+    def run_ffmpeg(self, cmd, cwd):
+        """在合并线程中运行ffmpeg：加上优先级前缀和超时，并登记进程以便取消"""
+        key = self._local.key
+
+        def on_start(proc):
+            with self._lock:
+                self._procs[key] = proc
+                cancelled = key in self._cancelled
+            if cancelled:
+                proc.kill()
+
+        try:
+            return run_ffmpeg(self.prefix + cmd, cwd, timeout=self.timeout, on_start=on_start)
+        finally:
+            with self._lock:
+                self._procs.pop(key, None)
+                cancelled = key in self._cancelled
+            if cancelled:
+                raise MergeCancelled(f'合并任务已取消: {key}')
+
+    def _loop(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            key, fn, args, kwargs, future = item
+            try:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                self._local.key = key
+                try:
+                    result = fn(*args, **kwargs)
+                except BaseException as e:
+                    future.set_exception(e)
+                else:
+                    future.set_result(result)
+            finally:
+                with self._lock:
+                    if self._futures.get(key) is future:
+                        del self._futures[key]
+                    self._cancelled.discard(key)
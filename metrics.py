@@ -0,0 +1,233 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+_LOGGER = logging.getLogger(__name__)
+
+# 延迟直方图的默认分桶（秒），覆盖单个API请求到整段视频合并
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+
+def _label_text(labels):
+    if not labels:
+        return ''
+    items = ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels)
+    return '{' + items + '}'
+
+
+def _value_text(value):
+    value = float(value)
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+class Metric:
+    type = ''
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self._lock = threading.Lock()
+        self._values = {}
+
+    @staticmethod
+    def _key(labels):
+        return tuple(sorted(labels.items()))
+
+    def samples(self):
+        """返回[(后缀, 标签, 值)]，用于导出和汇总"""
+        raise NotImplementedError
+
+    def exposition(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+        for suffix, labels, value in self.samples():
+            lines.append(f'{self.name}{suffix}{_label_text(labels)} {_value_text(value)}')
+        return lines
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, value=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def samples(self):
+        with self._lock:
+            return [('_total', key, value) for key, value in self._values.items()]
+
+
+class Gauge(Metric):
+    """当前值，也可以传入函数在导出时再取值（如队列长度）"""
+    type = 'gauge'
+
+    def __init__(self, name, help_text):
+        super().__init__(name, help_text)
+        self._functions = {}
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def set_function(self, fun, **labels):
+        with self._lock:
+            self._functions[self._key(labels)] = fun
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+            functions = dict(self._functions)
+        for key, fun in functions.items():
+            try:
+                values[key] = fun()
+            except Exception as e:
+                _LOGGER.debug('读取指标 %s 失败: %s', self.name, e)
+        return [('', key, value) for key, value in values.items()]
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            item = self._values.get(key)
+            if item is None:
+                item = self._values[key] = [[0] * len(self.buckets), 0, 0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    item[0][i] += 1
+            item[1] += 1
+            item[2] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        with self._lock:
+            values = [(key, list(item[0]), item[1], item[2]) for key, item in self._values.items()]
+        result = []
+        for key, buckets, count, total in values:
+            for bound, n in zip(self.buckets, buckets):
+                result.append(('_bucket', key + (('le', f'{bound:g}'),), n))
+            result.append(('_bucket', key + (('le', '+Inf'),), count))
+            result.append(('_count', key, count))
+            result.append(('_sum', key, total))
+        return result
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+        self._last = {}
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text):
+        return self.register(Counter(name, help_text))
+
+    def gauge(self, name, help_text):
+        return self.register(Gauge(name, help_text))
+
+    def histogram(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help_text, buckets))
+
+    def exposition(self):
+        lines = []
+        with self._lock:
+            metrics = list(self._metrics)
+        for metric in metrics:
+            lines += metric.exposition()
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """自上次汇总以来的全局变化（所有门铃和下载任务）：计数器的增量、直方图的次数与平均耗时，以及仪表的当前值
+
+        多个线程同时汇总时依次进行，每段变化只出现在一次汇总中。
+        """
+        with self._lock:
+            samples = [(metric, metric.samples()) for metric in self._metrics]
+            current = {
+                (metric.name, suffix, labels): value
+                for metric, items in samples
+                for suffix, labels, value in items
+                if suffix != '_bucket'
+            }
+            parts = []
+            for metric, items in samples:
+                for suffix, labels, value in items:
+                    key = (metric.name, suffix, labels)
+                    label = metric.name + _label_text(labels)
+                    if isinstance(metric, Gauge):
+                        parts.append(f'{label}={_value_text(value)}')
+                    elif isinstance(metric, Counter):
+                        delta = value - self._last.get(key, 0)
+                        if delta:
+                            parts.append(f'{label}=+{_value_text(delta)}')
+                    elif suffix == '_count':
+                        count = value - self._last.get(key, 0)
+                        sum_key = (metric.name, '_sum', labels)
+                        total = current.get(sum_key, 0) - self._last.get(sum_key, 0)
+                        if count:
+                            parts.append(f'{label}={count}次/平均{total / count * 1000:.0f}ms')
+            self._last = current
+        return ', '.join(parts)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.registry.exposition().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_http_server(port, host='127.0.0.1', registry=None):
+    """在后台线程中提供 /metrics 接口（Prometheus文本格式）"""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    server.registry = registry or REGISTRY
+    thread = threading.Thread(target=server.serve_forever, name='metrics', daemon=True)
+    thread.start()
+    _LOGGER.info('指标接口已启动: http://%s:%d/metrics', host, server.server_port)
+    return server
+
+
+REGISTRY = Registry()
+
+LOGIN_SECONDS = REGISTRY.histogram('doorbell_login_seconds', '米家账号登录耗时')
+API_SECONDS = REGISTRY.histogram('doorbell_api_request_seconds', '米家API请求耗时，包括设备列表和事件列表分页')
+API_ERRORS = REGISTRY.counter('doorbell_api_errors', '米家API请求失败次数')
+M3U8_SECONDS = REGISTRY.histogram('doorbell_m3u8_fetch_seconds', 'm3u8播放列表获取耗时')
+KEY_SECONDS = REGISTRY.histogram('doorbell_key_fetch_seconds', '分片解密密钥获取耗时')
+SEGMENT_SECONDS = REGISTRY.histogram('doorbell_segment_download_seconds', '单个分片下载（含解密）耗时')
+SEGMENT_BYTES = REGISTRY.counter('doorbell_segment_bytes', '下载的分片字节数')
+DECRYPT_SECONDS = REGISTRY.histogram('doorbell_segment_decrypt_seconds', '单个分片的AES解密耗时')
+FFMPEG_SECONDS = REGISTRY.histogram('doorbell_ffmpeg_seconds', 'ffmpeg合并耗时')
+EVENTS_FOUND = REGISTRY.counter('doorbell_events_found', '发现并加入下载队列的门铃事件数')
+JOBS = REGISTRY.counter('doorbell_jobs', '下载任务结果（done/retry/failed）')
+RATELIMIT_WAIT_SECONDS = REGISTRY.counter('doorbell_ratelimit_wait_seconds', '等待限速额度的累计时间（api/download）')
+QUEUE_DEPTH = REGISTRY.gauge('doorbell_queue_depth', '等待下载或合并的任务数')
@@ -0,0 +1,52 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+from doorbell import MiDoorbell, DoorbellEvent, VideoSegment
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class PlaylistPrefetcher:
+    """提前为接下来的事件签名、获取并解析m3u8及其密钥
+
+    当前事件下载分片时，后续事件的准备工作在后台进行；结果超过ttl秒（分片地址的签名可能已过期）
+    或获取失败时不使用，由download_video照常获取。最多保留max_entries个结果，最旧的先丢弃。
+    """
+
+    def __init__(self, workers=2, max_entries=32, ttl=600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='prefetch')
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def prefetch(self, cam: MiDoorbell, event: DoorbellEvent):
+        with self._lock:
+            if event.fileId in self._entries:
+                return
+            self._entries[event.fileId] = (time.monotonic(), self._pool.submit(cam.get_segments, event))
+            while len(self._entries) > self.max_entries:
+                _, (_, future) = self._entries.popitem(last=False)
+                future.cancel()
+
+    def take(self, event: DoorbellEvent) -> Optional[List[VideoSegment]]:
+        with self._lock:
+            entry = self._entries.pop(event.fileId, None)
+        if entry is None:
+            return None
+        created, future = entry
+        if time.monotonic() - created > self.ttl:
+            future.cancel()
+            return None
+        try:
+            return future.result()
+        except Exception as e:
+            _LOGGER.debug('预取播放列表失败 %s: %s', event.fileId, e)
+            return None
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,217 @@
+import collections
+import glob
+import heapq
+import itertools
+import json
+import logging
+import logging.handlers
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+_LOGGER = logging.getLogger(__name__)
+
+# 采样间隔（秒）
+SAMPLE_INTERVAL = 0.005
+# 写入采样报告时保留的热点函数数量
+REPORT_TOP = 40
+
+
+class SlowOps:
+    """常开的最慢操作记录，只保留耗时最长的limit条，开销只有一次堆操作"""
+
+    def __init__(self, limit=20):
+        self.limit = limit
+        self._heap = []
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+
+    def record(self, op, seconds, **detail):
+        item = (seconds, next(self._seq), op, time.time(), detail)
+        with self._lock:
+            if len(self._heap) < self.limit:
+                heapq.heappush(self._heap, item)
+            elif seconds > self._heap[0][0]:
+                heapq.heapreplace(self._heap, item)
+
+    def top(self):
+        with self._lock:
+            items = sorted(self._heap, reverse=True)
+        return [
+            {'op': op, 'seconds': round(seconds, 6), 'time': ts, **detail}
+            for seconds, _, op, ts, detail in items
+        ]
+
+    def save(self, path):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.top(), f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, path)
+
+
+class Sampler(threading.Thread):
+    """定时采集所有线程的调用栈，统计各调用栈出现的次数
+
+    cProfile只能分析调用它的线程，而一次检查的工作分布在门铃、下载和合并线程中，因此按采样方式分析。
+    """
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        super().__init__(name='profile-sampler', daemon=True)
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        me = threading.get_ident()
+        names = {}
+        while not self._stop_event.wait(self.interval):
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+    def hot_functions(self, top=REPORT_TOP):
+        """按自身耗时（栈顶）和累计耗时（出现在栈中）统计的热点函数"""
+        own = collections.Counter()
+        total = collections.Counter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(';')[1:]
+            if not frames:
+                continue
+            own[frames[-1]] += count
+            for frame in set(frames):
+                total[frame] += count
+        return own.most_common(top), total.most_common(top)
+
+
+class Profiler:
+    """按检查周期采样分析，并把分片级的耗时明细写入滚动日志文件
+
+    最慢操作始终记录，每个周期结束时写入slow_ops.json；开启分析后每个周期生成
+    cycle-<时间>-<名称>.folded（可直接生成火焰图）和对应的.txt热点报告，只保留最近keep个周期。
+    """
+
+    def __init__(self, directory='./data/profile', keep=20, slow_ops=20):
+        self.directory = directory
+        self.keep = keep
+        self.enabled = False
+        self.slow_ops = SlowOps(slow_ops)
+        self._active = threading.Lock()
+        self._trace = None
+
+    def configure(self, directory, keep=20, slow_ops=20):
+        self.directory = directory
+        self.keep = keep
+        self.slow_ops.limit = slow_ops
+
+    def enable(self):
+        os.makedirs(self.directory, exist_ok=True)
+        trace = logging.getLogger('doorbell.trace')
+        trace.propagate = False
+        trace.setLevel(logging.INFO)
+        handler = logging.handlers.RotatingFileHandler(
+            os.path.join(self.directory, 'trace.jsonl'), maxBytes=10 * 1024 * 1024,
+            backupCount=max(1, self.keep // 4), encoding='utf-8',
+        )
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        trace.addHandler(handler)
+        self._trace = trace
+        self.enabled = True
+        _LOGGER.info('已开启性能分析，结果保存在: %s', os.path.abspath(self.directory))
+
+    def record(self, op, seconds, **detail):
+        """记录一次操作的耗时：始终计入最慢操作，开启分析时同时写入明细"""
+        self.slow_ops.record(op, seconds, **detail)
+        if self._trace is not None:
+            self._trace.info(json.dumps({
+                'time': round(time.time(), 3),
+                'thread': threading.current_thread().name,
+                'op': op,
+                'seconds': round(seconds, 6),
+                **detail,
+            }, ensure_ascii=False))
+
+    @contextmanager
+    def timed(self, op, **detail):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(op, time.perf_counter() - start, **detail)
+
+    @contextmanager
+    def cycle(self, name):
+        """一个检查周期：开启分析时采样所有线程，同一时间只采样一个周期，重叠的周期不重复采样"""
+        start = time.perf_counter()
+        sampler = None
+        if self.enabled and self._active.acquire(blocking=False):
+            sampler = Sampler()
+            sampler.start()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self.record('cycle', seconds, name=name)
+            if sampler is not None:
+                sampler.stop()
+                try:
+                    self.write_cycle(name, seconds, sampler)
+                except OSError as e:
+                    _LOGGER.warning('保存性能分析结果失败: %s', e)
+                finally:
+                    self._active.release()
+            try:
+                self.slow_ops.save(os.path.join(self.directory, 'slow_ops.json'))
+            except OSError as e:
+                _LOGGER.debug('保存最慢操作记录失败: %s', e)
+
+    def write_cycle(self, name, seconds, sampler: Sampler):
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        safe_name = ''.join(c if c.isalnum() else '_' for c in name)
+        base = os.path.join(self.directory, f'cycle-{stamp}-{safe_name}')
+        with open(base + '.folded', 'w', encoding='utf-8') as f:
+            for stack, count in sampler.stacks.most_common():
+                f.write(f'{stack} {count}\n')
+
+        own, total = sampler.hot_functions()
+        with open(base + '.txt', 'w', encoding='utf-8') as f:
+            f.write(f'{name}: {seconds:.3f}s wall clock, {sampler.samples} samples every '
+                    f'{sampler.interval * 1000:.0f}ms, all threads\n')
+            for title, items in (('self', own), ('total', total)):
+                f.write(f'\n== top by {title} (thread samples) ==\n')
+                for frame, count in items:
+                    f.write(f'{count:>8}  {frame}\n')
+            f.write('\n== slowest operations ==\n')
+            for item in self.slow_ops.top():
+                f.write(json.dumps(item, ensure_ascii=False) + '\n')
+        self.rotate()
+
+    def rotate(self):
+        reports = sorted(glob.glob(os.path.join(self.directory, 'cycle-*.folded')))
+        for path in reports[:-self.keep] if self.keep > 0 else reports:
+            for ext in ('.folded', '.txt'):
+                try:
+                    os.remove(os.path.splitext(path)[0] + ext)
+                except OSError:
+                    pass
+
+
+PROFILER = Profiler()
@@ -0,0 +1,161 @@
+import asyncio
+import logging
+import threading
+import time
+from typing import List, NamedTuple, Optional
+
+import metrics
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """令牌桶，rate为每秒令牌数（0为不限），最多积累burst个
+
+    令牌不足时先记为欠账再等待，后来的请求排在欠账之后，单次取用可以超过burst（如一个大的数据块）。
+    """
+
+    def __init__(self, rate=0, burst=None):
+        self.rate = 0
+        self.burst = 0
+        self._tokens = 0
+        self._stamp = time.monotonic()
+        self._lock = threading.Lock()
+        self.set_rate(rate, burst)
+
+    def set_rate(self, rate, burst=None):
+        with self._lock:
+            self._refill()
+            unlimited = not self.rate
+            self.rate = max(0, rate or 0)
+            # 默认允许积累1秒的额度
+            self.burst = self.rate if burst is None else burst
+            self._tokens = self.burst if unlimited else min(self._tokens, self.burst)
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate:
+            self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+
+    def reserve(self, amount=1) -> float:
+        """取用amount个令牌，返回需要等待的秒数"""
+        with self._lock:
+            if not self.rate:
+                return 0
+            self._refill()
+            self._tokens -= amount
+            return -self._tokens / self.rate if self._tokens < 0 else 0
+
+
+class Budget(NamedTuple):
+    # 一天中的起止分钟，end小于start时跨过午夜
+    start: int
+    end: int
+    api_rate: float
+    download_mbps: float
+
+    def contains(self, minute) -> bool:
+        if self.start <= self.end:
+            return self.start <= minute < self.end
+        return minute >= self.start or minute < self.end
+
+
+def parse_clock(text) -> int:
+    hour, minute = str(text).split(':')
+    return int(hour) % 24 * 60 + int(minute)
+
+
+class RateLimiter:
+    """米家API请求数和分片下载字节数的共享限速
+
+    所有门铃、下载和补齐线程共用同一个限速器，额度用完时等待而不是失败，增加并发不会超过限额。
+    schedule按一天中的时段指定不同额度，如白天限制下载带宽、夜间不限，未覆盖的时段使用默认额度。
+    """
+
+    def __init__(self, api_rate=0, download_mbps=0, schedule: Optional[List[dict]] = None):
+        self.api = TokenBucket()
+        self.download = TokenBucket()
+        self.api_rate = 0
+        self.download_mbps = 0
+        self.schedule = []
+        self._current = None
+        self._minute = None
+        self._lock = threading.Lock()
+        self.configure(api_rate, download_mbps, schedule)
+
+    def configure(self, api_rate=0, download_mbps=0, schedule: Optional[List[dict]] = None):
+        """schedule: [{"start": "08:00", "end": "23:00", "api_rate": 2, "download_mbps": 8}, ...]，先匹配的时段优先"""
+        self.api_rate = api_rate
+        self.download_mbps = download_mbps
+        self.schedule = [
+            Budget(
+                parse_clock(item['start']),
+                parse_clock(item['end']),
+                item.get('api_rate', api_rate),
+                item.get('download_mbps', download_mbps),
+            )
+            for item in schedule or []
+        ]
+        with self._lock:
+            self._minute = None
+        self.refresh()
+
+    def budget(self, now=None):
+        """当前时段的(每秒API请求数, 下载Mbps)"""
+        local = time.localtime(now)
+        minute = local.tm_hour * 60 + local.tm_min
+        for budget in self.schedule:
+            if budget.contains(minute):
+                return budget.api_rate, budget.download_mbps
+        return self.api_rate, self.download_mbps
+
+    def refresh(self):
+        """每分钟最多检查一次是否进入了新的时段"""
+        minute = int(time.time() // 60)
+        with self._lock:
+            if minute == self._minute:
+                return
+            self._minute = minute
+            current = self.budget()
+            if current == self._current:
+                return
+            previous, self._current = self._current, current
+        api_rate, download_mbps = current
+        self.api.set_rate(api_rate, max(1, api_rate))
+        self.download.set_rate(download_mbps * 1e6 / 8)
+        if previous is not None or any(current):
+            _LOGGER.info('限速额度: API %s, 下载 %s', f'{api_rate}次/秒' if api_rate else '不限',
+                         f'{download_mbps}Mbps' if download_mbps else '不限')
+
+    def _reserve(self, bucket: TokenBucket, amount, name) -> float:
+        self.refresh()
+        delay = bucket.reserve(amount)
+        if delay > 0:
+            metrics.RATELIMIT_WAIT_SECONDS.inc(delay, limit=name)
+        return delay
+
+    def wait_api(self):
+        """每次米家API请求前调用"""
+        delay = self._reserve(self.api, 1, 'api')
+        if delay > 0:
+            time.sleep(delay)
+
+    def wait_bytes(self, size):
+        """每收到一块分片数据后调用"""
+        delay = self._reserve(self.download, size, 'download')
+        if delay > 0:
+            time.sleep(delay)
+
+    async def wait_api_async(self):
+        delay = self._reserve(self.api, 1, 'api')
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def wait_bytes_async(self, size):
+        delay = self._reserve(self.download, size, 'download')
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+LIMITER = RateLimiter()
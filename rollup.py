@@ -0,0 +1,293 @@
+import glob
+import itertools
+import json
+import logging
+import os
+import re
+import shutil
+import time
+from datetime import datetime, timedelta
+from typing import List, NamedTuple, Optional, Tuple
+
+from doorbell import STAGING_DIR, publish_file, remove_staging, run_ffmpeg
+from history import EventHistory
+
+_LOGGER = logging.getLogger(__name__)
+
+# 日期目录(yymmdd)及其中单个事件的视频(HHMMSS.mp4)
+DAY_PATTERN = re.compile(r'^\d{6}$')
+CLIP_PATTERN = re.compile(r'^(\d{2})(\d{2})(\d{2})\.mp4$')
+DURATION_PATTERN = re.compile(r'Duration: (\d+):(\d{2}):(\d{2}(?:\.\d+)?)')
+# ffmpeg输出中输入文件的音视频流，如 Stream #0:0[0x1](und): Video: hevc (Main) (...), yuv420p(tv), 2304x1296, ...
+STREAM_PATTERN = re.compile(r'^\s*Stream #\d+:\d+\S*: (Video|Audio): (\w+)(.*)$', re.M)
+RESOLUTION_PATTERN = re.compile(r'\b(\d{2,5}x\d{2,5})\b')
+SAMPLE_PATTERN = re.compile(r'(\d+ Hz, [^,]+)')
+# 合并后的总时长与各视频时长之和允许的误差：固定部分加每个视频的部分（秒）
+DURATION_TOLERANCE = 0.5
+CLIP_TOLERANCE = 0.1
+# 合并每日视频的ffmpeg进程的nice值，低于事件视频的合并
+NICE = 19
+# 持续运行时检查是否有可以合并的日期的间隔（秒）
+CHECK_INTERVAL = 6 * 3600
+
+
+class Clip(NamedTuple):
+    name: str
+    path: str
+    time: datetime
+    duration: float
+    size: int
+    # 各音视频流的(类型, 编码, 分辨率或采样率与声道)，相同时才能无损拼接
+    signature: Tuple[Tuple[str, str, str], ...]
+
+
+def rollup_cmd(ffmpeg, filelist_path, metadata_path, video_path) -> List[str]:
+    """无损拼接同一天的MP4，章节和标题来自ffmetadata文件"""
+    return [
+        ffmpeg,
+        '-f', 'concat',
+        '-safe', '0',
+        '-i', filelist_path,
+        '-i', metadata_path,
+        '-map', '0',
+        '-map_metadata', '1',
+        '-map_chapters', '1',
+        '-c', 'copy',
+        '-movflags', '+faststart',
+        '-y',
+        video_path,
+    ]
+
+
+def probe_cmd(ffmpeg, video_path) -> List[str]:
+    """读取视频的全部数据包但不解码也不输出，可以发现截断或损坏的文件，并在日志中给出时长"""
+    return [ffmpeg, '-hide_banner', '-i', video_path, '-map', '0', '-c', 'copy', '-f', 'null', '-']
+
+
+def verify_cmd(ffmpeg, video_path) -> List[str]:
+    """解码视频流、读取其余数据包，解码出错时ffmpeg以非0退出，可以发现编码参数不一致的拼接结果"""
+    return [ffmpeg, '-hide_banner', '-xerror', '-i', video_path, '-map', '0:v', '-map', '0:a?', '-c:a', 'copy',
+            '-f', 'null', '-']
+
+
+def stream_signature(stderr) -> Tuple[Tuple[str, str, str], ...]:
+    """从ffmpeg输出中解析输入文件各音视频流的编码参数，不包括输出部分"""
+    text = re.split(r'^Output #', stderr, maxsplit=1, flags=re.M)[0]
+    streams = []
+    for kind, codec, rest in STREAM_PATTERN.findall(text):
+        match = (RESOLUTION_PATTERN if kind == 'Video' else SAMPLE_PATTERN).search(rest)
+        streams.append((kind, codec, match.group(1) if match else ''))
+    return tuple(streams)
+
+
+def quote_concat_path(path):
+    return "'" + path.replace("'", "'\\''") + "'"
+
+
+def escape_metadata(text):
+    return re.sub(r'([=;#\\\n])', r'\\\1', text)
+
+
+class ArchiveRollup:
+    """把已结束的一天中每个门铃的事件视频无损合并为一个MP4，减少归档中的小文件
+
+    save_path/门铃/年月/日期/时间.mp4 合并为 save_path/门铃/年月/日期.mp4，每个事件是一个章节，
+    同名的.json索引记录每个事件在合并视频中的偏移和时长。合并结果校验通过后才删除原视频。
+    编码参数不同的视频（如升级前转码的H264和之后的H265）不能无损拼接，按时间顺序分段合并为 日期.mp4、日期-2.mp4 等。
+    日期结束超过delay_hours、且该日期没有未完成的下载任务时才合并（失败任务留下的暂存目录一并删除）；合并之后又出现的视频合并为 日期-2.mp4 等。
+    """
+
+    def __init__(self, save_path, ffmpeg, delay_hours=72, history: Optional[EventHistory] = None):
+        self.save_path = save_path
+        self.ffmpeg = ffmpeg
+        self.delay = delay_hours * 3600
+        self.history = history
+
+    def closed_days(self, door, now=None) -> List[str]:
+        """返回门铃可以合并的日期目录"""
+        now = time.time() if now is None else now
+        days = []
+        door_dir = os.path.join(os.path.abspath(self.save_path), door)
+        for day_dir in sorted(glob.glob(os.path.join(glob.escape(door_dir), '*', '*'))):
+            day = os.path.basename(day_dir)
+            if not DAY_PATTERN.match(day) or not os.path.isdir(day_dir):
+                continue
+            try:
+                begin = datetime.strptime(day, '%y%m%d')
+            except ValueError:
+                continue
+            end = begin + timedelta(days=1)
+            if end.timestamp() + self.delay > now:
+                continue
+            staging = os.path.join(day_dir, STAGING_DIR)
+            if self.history is None:
+                # 无法确认暂存目录中的事件是否仍在处理，等暂存目录清空后再合并
+                if os.path.isdir(staging):
+                    continue
+            elif self.history.active_jobs(door, int(begin.timestamp() * 1000), int(end.timestamp() * 1000)):
+                continue
+            elif os.path.isdir(staging):
+                # 该日期的任务都已完成或失败，剩下的是失败任务的分片，云端视频已过期，不会再续传
+                _LOGGER.info('删除已失败任务的暂存目录: %s', staging)
+                shutil.rmtree(staging, ignore_errors=True)
+            if any(CLIP_PATTERN.match(name) for name in os.listdir(day_dir)):
+                days.append(day_dir)
+        return days
+
+    def indexed_clips(self, day_dir):
+        """该日期已有的合并索引中记录的视频名"""
+        names = set()
+        month_dir, day = os.path.split(day_dir)
+        for path in glob.glob(os.path.join(glob.escape(month_dir), glob.escape(day) + '*.json')):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    names.update(clip['name'] for clip in json.load(f)['clips'])
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                _LOGGER.warning('读取合并索引失败 %s: %s', path, e)
+        return names
+
+    def output_base(self, day_dir):
+        month_dir, day = os.path.split(day_dir)
+        base = os.path.join(month_dir, day)
+        n = 1
+        while os.path.exists(base + '.mp4') or os.path.exists(base + '.json'):
+            n += 1
+            base = os.path.join(month_dir, f'{day}-{n}')
+        return base
+
+    def probe(self, video_path, runner=run_ffmpeg, decode=False) -> Tuple[float, Tuple[Tuple[str, str, str], ...]]:
+        """返回视频的时长和各音视频流的编码参数，decode时完整解码视频流"""
+        cmd = verify_cmd(self.ffmpeg, video_path) if decode else probe_cmd(self.ffmpeg, video_path)
+        result = runner(cmd, os.path.dirname(video_path))
+        match = DURATION_PATTERN.search(result.stderr or '')
+        if not match:
+            raise Exception(f'无法读取视频时长: {video_path}')
+        signature = stream_signature(result.stderr)
+        if not any(kind == 'Video' for kind, _, _ in signature):
+            raise Exception(f'无法读取视频流信息: {video_path}')
+        hours, minutes, seconds = match.groups()
+        return int(hours) * 3600 + int(minutes) * 60 + float(seconds), signature
+
+    def compact_day(self, door, day_dir, runner=run_ffmpeg) -> List[str]:
+        """合并一个日期目录，返回合并后的视频路径；没有需要合并的视频时返回空列表，合并或校验失败时抛出异常"""
+        month_dir, day = os.path.split(day_dir)
+        date = datetime.strptime(day, '%y%m%d')
+
+        # 上次合并在删除原视频前中断：这些视频已包含在校验过的合并视频中，直接删除
+        indexed = self.indexed_clips(day_dir)
+        names = sorted(name for name in os.listdir(day_dir) if CLIP_PATTERN.match(name))
+        for name in names:
+            if name in indexed:
+                os.remove(os.path.join(day_dir, name))
+        names = [name for name in names if name not in indexed]
+        if not names:
+            self.remove_day_dir(day_dir)
+            return []
+
+        clips = []
+        for name in names:
+            path = os.path.join(day_dir, name)
+            hour, minute, second = map(int, CLIP_PATTERN.match(name).groups())
+            duration, signature = self.probe(path, runner)
+            clips.append(Clip(
+                name=name,
+                path=path,
+                time=date.replace(hour=hour, minute=minute, second=second),
+                duration=duration,
+                size=os.path.getsize(path),
+                signature=signature,
+            ))
+
+        runs = [list(run) for _, run in itertools.groupby(clips, key=lambda clip: clip.signature)]
+        if len(runs) > 1:
+            _LOGGER.warning('门铃 %s %s的视频编码参数不一致，按时间顺序分为%d段合并', door,
+                            date.strftime('%Y-%m-%d'), len(runs))
+        videos = [self.compact_run(door, day_dir, date, run, runner) for run in runs]
+        self.remove_day_dir(day_dir)
+        return videos
+
+    def compact_run(self, door, day_dir, date, clips: List[Clip], runner=run_ffmpeg) -> str:
+        """合并编码参数相同的一组视频，校验通过后删除原视频"""
+        month_dir = os.path.dirname(day_dir)
+        base = self.output_base(day_dir)
+        staging = os.path.join(month_dir, STAGING_DIR, 'rollup-' + os.path.basename(base))
+        os.makedirs(staging, exist_ok=True)
+        staged_video = os.path.join(staging, os.path.basename(base) + '.mp4')
+        try:
+            filelist_path = os.path.join(staging, 'filelist')
+            with open(filelist_path, 'w', encoding='utf-8') as f:
+                for clip in clips:
+                    f.write(f'file {quote_concat_path(clip.path)}\n')
+            metadata_path = os.path.join(staging, 'metadata.txt')
+            with open(metadata_path, 'w', encoding='utf-8') as f:
+                f.write(self.ffmetadata(door, date, clips))
+
+            runner(rollup_cmd(self.ffmpeg, filelist_path, metadata_path, staged_video), staging)
+
+            # 校验：合并结果的视频流可以完整解码，编码参数不变，且总时长与各视频之和一致
+            expected = sum(clip.duration for clip in clips)
+            duration, signature = self.probe(staged_video, runner, decode=True)
+            if signature != clips[0].signature:
+                raise Exception(f'合并后的编码参数{signature}与原视频{clips[0].signature}不一致')
+            if abs(duration - expected) > DURATION_TOLERANCE + CLIP_TOLERANCE * len(clips):
+                raise Exception(f'合并后时长{duration:.2f}s与各视频之和{expected:.2f}s不一致')
+
+            staged_index = os.path.join(staging, os.path.basename(base) + '.json')
+            with open(staged_index, 'w', encoding='utf-8') as f:
+                json.dump(self.index(door, date, base, clips, duration), f, ensure_ascii=False, indent=1)
+
+            # 先发布视频再发布索引：中断时最多留下一份重复的合并视频，不会因索引误删原视频
+            publish_file(staged_video, base + '.mp4')
+            publish_file(staged_index, base + '.json')
+        finally:
+            remove_staging(staging)
+
+        for clip in clips:
+            os.remove(clip.path)
+        _LOGGER.info('门铃 %s %s的%d个视频已合并为: %s', door, date.strftime('%Y-%m-%d'), len(clips), base + '.mp4')
+        return base + '.mp4'
+
+    @staticmethod
+    def ffmetadata(door, date, clips: List[Clip]):
+        lines = [';FFMETADATA1', f'title={escape_metadata(door)} {date:%Y-%m-%d}']
+        offset = 0
+        for clip in clips:
+            start = round(offset * 1000)
+            offset += clip.duration
+            lines += [
+                '[CHAPTER]',
+                'TIMEBASE=1/1000',
+                f'START={start}',
+                f'END={round(offset * 1000)}',
+                f'title={clip.time:%H:%M:%S}',
+            ]
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def index(door, date, base, clips: List[Clip], duration):
+        items = []
+        offset = 0
+        for clip in clips:
+            items.append({
+                'name': clip.name,
+                'time': clip.time.strftime('%Y-%m-%d %H:%M:%S'),
+                'offset': round(offset, 3),
+                'duration': round(clip.duration, 3),
+                'size': clip.size,
+            })
+            offset += clip.duration
+        return {
+            'door': door,
+            'date': date.strftime('%Y-%m-%d'),
+            'video': os.path.basename(base) + '.mp4',
+            'duration': round(duration, 3),
+            'clips': items,
+        }
+
+    @staticmethod
+    def remove_day_dir(day_dir):
+        """日期目录中还有其他文件（如未合并的分片目录）时保留"""
+        try:
+            os.rmdir(day_dir)
+        except OSError:
+            pass
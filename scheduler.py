@@ -0,0 +1,118 @@
+import heapq
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, NamedTuple, Optional
+
+from ratelimit import parse_clock
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class ActiveWindow(NamedTuple):
+    # 一天中的起止分钟，end小于start时跨过午夜
+    start: int
+    end: int
+    max_interval: float
+
+    def contains(self, minute) -> bool:
+        if self.start <= self.end:
+            return self.start <= minute < self.end
+        return minute >= self.start or minute < self.end
+
+
+class AdaptiveScheduler:
+    """按门铃独立调度的轮询器
+
+    task(key) 返回本次发现的新事件数：有新事件时间隔回到最小值，空闲时按倍数退避到最大值，
+    每次间隔加入随机抖动。同一个key在上一次执行结束前不会再次执行。
+    active_hours中的时段（如白天）空闲间隔最多为active_max_interval，较长的退避只在时段之外进行，
+    退避期间进入时段时也会按该时段的间隔检查。
+    """
+
+    def __init__(self, task, keys, min_interval=60, max_interval=3600, backoff=2.0, jitter=0.1,
+                 max_workers=4, active_hours: Optional[List[dict]] = None, active_max_interval=60):
+        self.task = task
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        # active_hours: [{"start": "07:00", "end": "23:00", "max_seconds": 60}, ...]，先匹配的时段优先
+        self.active = [
+            ActiveWindow(
+                parse_clock(item['start']),
+                parse_clock(item['end']),
+                max(min_interval, item.get('max_seconds', active_max_interval)),
+            )
+            for item in active_hours or []
+        ]
+        self.backoff = backoff
+        self.jitter = jitter
+        self.max_workers = max(1, max_workers)
+        self.intervals = {key: min_interval for key in keys}
+        self._queue = [(time.time(), key) for key in keys]
+        heapq.heapify(self._queue)
+        self._running = set()
+        self._cond = threading.Condition()
+        self._stopped = False
+
+    def max_interval_at(self, now=None):
+        """当前时段的最长空闲间隔"""
+        local = time.localtime(now)
+        minute = local.tm_hour * 60 + local.tm_min
+        for window in self.active:
+            if window.contains(minute):
+                return window.max_interval
+        return self.max_interval
+
+    def next_interval(self, key, found, now=None):
+        now = time.time() if now is None else now
+        if found:
+            interval = self.min_interval
+        else:
+            interval = min(self.intervals[key] * self.backoff, self.max_interval_at(now))
+        self.intervals[key] = interval
+        spread = interval * self.jitter
+        delay = max(1, interval + random.uniform(-spread, spread))
+        # 退避期间进入时段时，最晚在时段开始后的max_interval内检查
+        local = time.localtime(now)
+        second = local.tm_hour * 3600 + local.tm_min * 60 + local.tm_sec
+        for window in self.active:
+            until = (window.start * 60 - second) % 86400
+            delay = min(delay, until + window.max_interval)
+        return delay
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+    def run_forever(self):
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            while True:
+                with self._cond:
+                    if self._stopped:
+                        return
+                    now = time.time()
+                    if not self._queue or self._queue[0][0] > now:
+                        timeout = self._queue[0][0] - now if self._queue else None
+                        self._cond.wait(timeout)
+                        continue
+                    _, key = heapq.heappop(self._queue)
+                    if key in self._running:
+                        continue
+                    self._running.add(key)
+                pool.submit(self._run, key)
+
+    def _run(self, key):
+        found = 0
+        try:
+            found = self.task(key) or 0
+        except Exception as e:
+            _LOGGER.error('%s 检查出错:%s', key, e)
+        delay = self.next_interval(key, found)
+        _LOGGER.debug('%s 下次检查在 %d 秒后', key, delay)
+        with self._cond:
+            self._running.discard(key)
+            heapq.heappush(self._queue, (time.time() + delay, key))
+            self._cond.notify_all()
@@ -1,16 +1,25 @@
 import logging
 import json
+import os
 import time
 import string
 import random
 import base64
 import hashlib
+import threading
+import functools
 import micloud
 import requests
 from urllib import parse
+from requests.adapters import HTTPAdapter
 
 from micloud import miutils
 from micloud.micloudexception import MiCloudException
+from Crypto.Cipher import ARC4
+
+import metrics
+from profiling import PROFILER
+from ratelimit import LIMITER
 
 try:
     from micloud.micloudexception import MiCloudAccessDenied
@@ -21,6 +30,12 @@ except (ModuleNotFoundError, ImportError):
 _LOGGER = logging.getLogger(__name__)
 ACCOUNT_BASE = 'https://account.xiaomi.com'
 UA = "Android-7.1.1-1.0.0-ONEPLUS A3010-136-%s APP/xiaomi.smarthome APPV/62830"
+# Cookies carrying the service token are only sent to xiaomi iot api hosts,
+# never to the video CDN that shares the pooled session.
+API_COOKIE_DOMAIN = '.io.mi.com'
+API_HEADERS = {
+    'Content-Type': 'application/x-www-form-urlencoded',
+}
 
 
 class RC4:
@@ -65,8 +80,21 @@ class RC4:
         return self
 
 
+@functools.lru_cache(maxsize=64)
+def rc4_key(pwd: str) -> bytes:
+    return base64.b64decode(pwd)
+
+
+def rc4_crypt(key: bytes, data) -> bytearray:
+    """RC4-drop1024, equivalent to RC4(key).init1024().crypt(data)."""
+    if isinstance(data, str):
+        data = data.encode()
+    return bytearray(ARC4.new(key, drop=1024).encrypt(data))
+
+
 class MiotCloud(micloud.MiCloud):
-    def __init__(self, username, password, country=None, sid=None):
+    def __init__(self, username, password, country=None, sid=None, pool_size=10, token_path=None,
+                 api_base=None):
         try:
             super().__init__(username, password)
         except (FileNotFoundError, KeyError):
@@ -81,6 +109,16 @@ class MiotCloud(micloud.MiCloud):
         self.http_timeout = 10
         self.login_times = 0
         self.attrs = {}
+        self.pool_size = pool_size
+        # Send every api request to this base url instead of the xiaomi hosts (local stub servers)
+        self.api_base = api_base.rstrip('/') if api_base else None
+        self._http = None
+        self._http_token = None
+        self._http_lock = threading.Lock()
+        self.token_path = token_path
+        self.token_time = None
+        self._login_lock = threading.RLock()
+        self._refresher = None
 
     @property
     def unique_id(self):
@@ -161,11 +199,22 @@ class MiotCloud(micloud.MiCloud):
         return vls.pop(0)
 
     def request_miot_api(self, api, data, method='POST', crypt=True, debug=True, **kwargs):
+        token = self.service_token
+        rdt = self._request_miot_api(api, data, method, crypt, debug, **kwargs)
+        # The token was rejected (code 3 or http 401): login again and retry once
+        if token and not self.service_token and self.relogin(token):
+            rdt = self._request_miot_api(api, data, method, crypt, debug, **kwargs)
+        return rdt
+
+    def _request_miot_api(self, api, data, method='POST', crypt=True, debug=True, **kwargs):
         params = {}
         if data is not None:
             params['data'] = self.json_encode(data)
         raw = kwargs.pop('raw', self.sid != 'xiaomiio')
         rsp = None
+        api_name = parse.urlparse(api).path.strip('/')
+        error = None
+        start = time.perf_counter()
         try:
             if raw:
                 rsp = self.request_raw(api, data, method, **kwargs)
@@ -182,13 +231,18 @@ class MiotCloud(micloud.MiCloud):
             self.attrs['timeouts'] = 0
         except requests.exceptions.Timeout as exc:
             rdt = None
+            error = 'timeout'
             self.attrs.setdefault('timeouts', 0)
             self.attrs['timeouts'] += 1
             if 5 < self.attrs['timeouts'] <= 10:
                 _LOGGER.error('Request xiaomi api: %s %s timeout, exception: %s', api, data, exc)
         except (TypeError, ValueError):
             rdt = None
+        metrics.API_SECONDS.observe(time.perf_counter() - start, api=api_name)
+        PROFILER.record('api', time.perf_counter() - start, api=api_name)
         code = rdt.get('code') if rdt else None
+        if code or not rdt:
+            metrics.API_ERRORS.inc(api=api_name, reason=error or (f'code_{code}' if code else 'empty'))
         if code == 3:
             self._logout()
             _LOGGER.warning('Unauthorized while executing request to %s, logged out.', api)
@@ -229,6 +283,127 @@ class MiotCloud(micloud.MiCloud):
     def _logout(self):
         self.service_token = None
 
+    def login(self):
+        if self.service_token and self.user_id:
+            return True
+        with self._login_lock:
+            if self.service_token and self.user_id:
+                return True
+            # Only fall back to the token file before the first login,
+            # a token rejected by the api must not be loaded again.
+            if self.token_time is None and self.load_token():
+                return True
+            with metrics.LOGIN_SECONDS.time():
+                ok = super().login()
+            if not ok or not self.service_token:
+                return False
+            self.token_time = time.time()
+            self.save_token()
+            return True
+
+    def relogin(self, stale_token=None):
+        with self._login_lock:
+            if self.service_token and self.service_token != stale_token:
+                # Another thread already logged in again
+                return True
+            self._logout()
+            return self.login()
+
+    def refresh_token(self):
+        """Login again while keeping the current token usable until the new one arrives.
+
+        The login runs on a separate client, its credentials are swapped in only after
+        the whole login succeeded, so a failed refresh leaves this client untouched.
+        """
+        login = MiotCloud(self.username, self.password, country=self.default_server, sid=self.sid)
+        login.agent_id = login.client_id = self.client_id
+        login.useragent = self.useragent
+        try:
+            login._login_request()
+        except Exception as exc:
+            _LOGGER.warning('Refresh xiaomi token failed, keep using the current one: %s', exc)
+            return False
+        if not login.service_token:
+            _LOGGER.warning('Refresh xiaomi token failed, keep using the current one: no service token')
+            return False
+        with self._login_lock:
+            self.user_id = login.user_id
+            self.cuser_id = login.cuser_id
+            self.ssecurity = login.ssecurity
+            self.pass_token = login.pass_token
+            self.service_token = login.service_token
+            self.token_time = time.time()
+            self.save_token()
+        _LOGGER.info('Xiaomi service token refreshed')
+        return True
+
+    def start_token_refresher(self, refresh_after=3600 * 20, interval=600):
+        """Refresh the service token in background once it is older than refresh_after seconds."""
+        if self._refresher and self._refresher.is_alive():
+            return self._refresher
+
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    if self.token_time and time.time() - self.token_time >= refresh_after:
+                        self.refresh_token()
+                except Exception as exc:
+                    # Keep the refresher alive, the next round tries again
+                    _LOGGER.warning('Xiaomi token refresher error: %s', exc)
+
+        self._refresher = threading.Thread(target=run, name='xiaomi-token-refresher', daemon=True)
+        self._refresher.start()
+        return self._refresher
+
+    def token_data(self):
+        return {
+            'username': self.username,
+            'server': self.default_server,
+            'sid': self.sid,
+            'user_id': self.user_id,
+            'cuser_id': self.cuser_id,
+            'service_token': self.service_token,
+            'ssecurity': self.ssecurity,
+            'token_time': self.token_time,
+        }
+
+    def load_token(self):
+        if not self.token_path or not os.path.exists(self.token_path):
+            return False
+        try:
+            with open(self.token_path, 'r', encoding='utf-8') as f:
+                dat = json.load(f) or {}
+        except (OSError, ValueError) as exc:
+            _LOGGER.warning('Load xiaomi token from %s failed: %s', self.token_path, exc)
+            return False
+        if (dat.get('username'), dat.get('server'), dat.get('sid')) != (self.username, self.default_server, self.sid):
+            return False
+        if not dat.get('service_token') or not dat.get('ssecurity') or not dat.get('user_id'):
+            return False
+        self.user_id = dat['user_id']
+        self.cuser_id = dat.get('cuser_id')
+        self.ssecurity = dat['ssecurity']
+        self.service_token = dat['service_token']
+        self.token_time = dat.get('token_time') or time.time()
+        _LOGGER.debug('Loaded xiaomi token from %s', self.token_path)
+        return True
+
+    def save_token(self):
+        if not self.token_path:
+            return False
+        tmp = f'{self.token_path}.tmp'
+        try:
+            if os.path.dirname(self.token_path):
+                os.makedirs(os.path.dirname(self.token_path), exist_ok=True)
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(self.token_data(), f)
+            os.replace(tmp, self.token_path)
+        except OSError as exc:
+            _LOGGER.warning('Save xiaomi token to %s failed: %s', self.token_path, exc)
+            return False
+        return True
+
     def _login_request(self, captcha=None):
         self._init_session()
         auth = self.attrs.pop('login_data', None)
@@ -301,7 +476,7 @@ class MiotCloud(micloud.MiCloud):
                 if ntf[:4] != 'http':
                     ntf = f'{ACCOUNT_BASE}{ntf}'
                 self.attrs['notificationUrl'] = ntf
-            _LOGGER.error('Xiaomi serviceLoginAuth2: %s', [url, params, post, headers, cookies])
+            _LOGGER.error('Xiaomi serviceLoginAuth2: %s', [url, params, code, auth.get('desc')])
             raise MiCloudAccessDenied(f'Login to xiaomi error: {response.text}')
         self.user_id = str(auth.get('userId', ''))
         self.cuser_id = auth.get('cUserId')
@@ -342,17 +517,36 @@ class MiotCloud(micloud.MiCloud):
             self.attrs['captchaImg'] = base64.b64encode(response.content).decode()
         return response
 
+    def http_session(self):
+        """Long-lived pooled session shared by api requests and video downloads."""
+        with self._http_lock:
+            if self._http is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                session.headers.update({
+                    'X-XIAOMI-PROTOCAL-FLAG-CLI': 'PROTOCAL-HTTP2',
+                    'User-Agent': self.useragent,
+                })
+                self._http = session
+            return self._http
+
     def api_session(self):
         if not self.service_token or not self.user_id:
             raise MiCloudException('Cannot execute request. service token or userId missing. Make sure to login.')
 
-        session = requests.Session()
-        session.headers.update({
-            'X-XIAOMI-PROTOCAL-FLAG-CLI': 'PROTOCAL-HTTP2',
-            'Content-Type': 'application/x-www-form-urlencoded',
-            'User-Agent': self.useragent,
-        })
-        session.cookies.update({
+        session = self.http_session()
+        with self._http_lock:
+            # Only rebuild the auth cookies when the service token changed
+            if self._http_token != self.service_token:
+                for k, v in self.api_cookies().items():
+                    session.cookies.set(k, v, domain=API_COOKIE_DOMAIN)
+                self._http_token = self.service_token
+        return session
+
+    def api_cookies(self):
+        return {
             'userId': str(self.user_id),
             'yetAnotherServiceToken': self.service_token,
             'serviceToken': self.service_token,
@@ -361,11 +555,11 @@ class MiotCloud(micloud.MiCloud):
             'is_daylight': str(time.daylight),
             'dst_offset': str(time.localtime().tm_isdst * 60 * 60 * 1000),
             'channel': 'MI_APP_STORE',
-        })
-        return session
+        }
 
     def request(self, url, params, **kwargs):
-        self.session = self.api_session()
+        session = self.api_session()
+        LIMITER.wait_api()
         timeout = kwargs.get('timeout', self.http_timeout)
         try:
             nonce = miutils.gen_nonce()
@@ -376,7 +570,7 @@ class MiotCloud(micloud.MiCloud):
                 '_nonce': nonce,
                 'data': params['data'],
             }
-            response = self.session.post(url, data=post_data, timeout=timeout)
+            response = session.post(url, data=post_data, headers=API_HEADERS, timeout=timeout)
             return response.text
         except requests.exceptions.HTTPError as exc:
             _LOGGER.error('Error while executing request to %s: %s', url, exc)
@@ -384,20 +578,22 @@ class MiotCloud(micloud.MiCloud):
             _LOGGER.error('Error while decrypting response of request to %s: %s', url, exc)
 
     def request_rc4_api(self, api, params: dict, method='POST', **kwargs):
-        self.session = self.api_session()
-        self.session.headers.update({
+        session = self.api_session()
+        headers = {
+            **API_HEADERS,
             'MIOT-ENCRYPT-ALGORITHM': 'ENCRYPT-RC4',
             'Accept-Encoding': 'identity',
-        })
+        }
         url = self.get_api_url(api)
         timeout = kwargs.get('timeout', self.http_timeout)
+        LIMITER.wait_api()
         try:
             params = self.rc4_params(method, url, params)
             signed_nonce = self.signed_nonce(params['_nonce'])
             if method == 'GET':
-                response = self.session.get(url, params=params, timeout=timeout)
+                response = session.get(url, params=params, headers=headers, timeout=timeout)
             else:
-                response = self.session.post(url, data=params, timeout=timeout)
+                response = session.post(url, data=params, headers=headers, timeout=timeout)
             rsp = response.text
             if not rsp or 'error' in rsp or 'invalid' in rsp:
                 _LOGGER.warning('Error while executing request to %s: %s', url, rsp or response.status_code)
@@ -413,12 +609,14 @@ class MiotCloud(micloud.MiCloud):
             _LOGGER.warning('Error while decrypting response of request to %s :%s', url, exc)
 
     def request_raw(self, url, data=None, method='GET', **kwargs):
-        self.session = self.api_session()
+        session = self.api_session()
         url = self.get_api_url(url)
         kwargs.setdefault('params' if method == 'GET' else 'data', data)
         kwargs.setdefault('timeout', self.http_timeout)
+        kwargs.setdefault('headers', API_HEADERS)
+        LIMITER.wait_api()
         try:
-            response = self.session.request(method, url, **kwargs)
+            response = session.request(method, url, **kwargs)
             if response.status_code == 401:
                 self._logout()
                 _LOGGER.warning('Unauthorized while executing request to %s, logged out.', url)
@@ -436,6 +634,8 @@ class MiotCloud(micloud.MiCloud):
         if srv and srv != 'cn':
             host = f'{srv}.{host}'
         api = str(api).lstrip('/')
+        if self.api_base:
+            return f'{self.api_base}/{api}'
         return f'https://{host}/{api}'
 
     def get_api_url(self, api):
@@ -443,7 +643,8 @@ class MiotCloud(micloud.MiCloud):
             url = api
         else:
             api = str(api).lstrip('/')
-            url = self._get_api_url(self.default_server) + '/' + api
+            base = f'{self.api_base}/app' if self.api_base else self._get_api_url(self.default_server)
+            url = base + '/' + api
         return url
 
     def rc4_params(self, method, url, params: dict):
@@ -480,11 +681,11 @@ class MiotCloud(micloud.MiCloud):
 
     @staticmethod
     def encrypt_data(pwd, data):
-        return base64.b64encode(RC4(base64.b64decode(pwd)).init1024().crypt(data)).decode()
+        return base64.b64encode(rc4_crypt(rc4_key(pwd), data)).decode()
 
     @staticmethod
     def decrypt_data(pwd, data):
-        return RC4(base64.b64decode(pwd)).init1024().crypt(base64.b64decode(data))
+        return rc4_crypt(rc4_key(pwd), base64.b64decode(data))
 
     @staticmethod
     def get_random_string(length):